@@ -0,0 +1,90 @@
+"""Scaling benchmark of data parallel training, see data_parallel.py.
+
+Trains the model for a number of steps with 1, 2, 4, ... up to max_workers
+worker processes and reports the samples/sec of each, counted from the
+second step on so that start up is left out:
+
+  python benchmark_data_parallel.py model.pbtxt train_data.pbtxt max_workers results.json [num_steps]
+
+Each run is a separate process whose BLAS uses cpu_count / num_workers
+threads, so that the workers do not oversubscribe the cores. Validation,
+saving and display are turned off and the model is written to a temporary
+checkpoint_dir.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+
+def GetNumWorkers(max_workers):
+  num_workers = []
+  n = 1
+  while n < max_workers:
+    num_workers.append(n)
+    n *= 2
+  num_workers.append(max_workers)
+  return num_workers
+
+def Run(model_file, data_file, num_workers, num_steps):
+  from lstm_combo import LSTMCombo
+  from lstm_classifier import LSTMClassifier
+  from data_parallel import TrainDataParallel
+  from util import ReadModelProto, ReadDataProto
+  model = ReadModelProto(model_file)
+  data_pb = ReadDataProto(data_file)
+  model_class = LSTMCombo if model.dec_seq_length > 0 or model.future_seq_length > 0 else LSTMClassifier
+  model.num_workers = num_workers
+  model.max_iters = num_steps
+  model.print_after = num_steps
+  model.validate_after = 0
+  model.save_after = 0
+  model.display_after = 0
+  del model.timestamp[:]
+  model.checkpoint_dir = tempfile.mkdtemp()
+  try:
+    averager = TrainDataParallel(model_class, model, data_pb)
+  finally:
+    shutil.rmtree(model.checkpoint_dir)
+  steps, seconds = averager.GetStats()
+  samples_per_sec = num_workers * data_pb.batch_size * (steps - 1) / seconds
+  return {'num_workers': num_workers, 'steps': steps, 'seconds': seconds, 'samples_per_sec': samples_per_sec}
+
+def RunInSubprocess(model_file, data_file, num_workers, num_steps):
+  env = dict(os.environ)
+  threads = str(max(1, multiprocessing.cpu_count() / num_workers))
+  for name in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+    env[name] = threads
+  proc = subprocess.Popen([sys.executable, __file__, '--run', model_file, data_file, str(num_workers), str(num_steps)],
+                          stdout=subprocess.PIPE, env=env)
+  out, _ = proc.communicate()
+  if proc.returncode != 0:
+    raise Exception('Benchmark with %d workers failed.' % num_workers)
+  return json.loads(out.strip().split('\n')[-1])
+
+def main():
+  if sys.argv[1] == '--run':
+    print json.dumps(Run(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5])))
+    return 0
+  model_file, data_file = sys.argv[1], sys.argv[2]
+  max_workers = int(sys.argv[3])
+  num_steps = int(sys.argv[5]) if len(sys.argv) > 5 else 20
+
+  results = []
+  for num_workers in GetNumWorkers(max_workers):
+    result = RunInSubprocess(model_file, data_file, num_workers, num_steps)
+    result['speedup'] = result['samples_per_sec'] / (results[0]['samples_per_sec'] if results else result['samples_per_sec'])
+    result['efficiency'] = result['speedup'] / num_workers
+    results.append(result)
+    print '%3d workers %10.1f samples/s speedup %5.2f efficiency %3.0f%%' % (
+      num_workers, result['samples_per_sec'], result['speedup'], 100 * result['efficiency'])
+  with open(sys.argv[4], 'w') as f:
+    json.dump(results, f, indent=2, sort_keys=True)
+  print 'Results written to %s' % sys.argv[4]
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
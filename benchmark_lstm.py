@@ -0,0 +1,193 @@
+"""Micro-benchmark of LSTM.Fprop, LSTM.BpropAndOutp and ParamBuffer.Update.
+
+Runs on the CPU backend, one process per configuration so that the peak memory
+of each one is measured on its own. The peak of a process only grows, so for
+each phase what is reported is how much it raised the peak. Results are written as JSON and can be
+compared against the JSON of an earlier run:
+
+  python benchmark_lstm.py results.json [baseline.json] [--quick]
+
+Speeds more than 10% below the baseline are reported as regressions and make
+the script exit with status 1.
+"""
+
+import os
+os.environ['CUDAMAT_BACKEND'] = 'cpu'
+
+import sys
+import json
+import resource
+import subprocess
+from util import *
+import lstm
+
+# Each sweep varies one setting of the base configuration.
+BASE = dict(num_hid=1024, input_dims=1024, batch_size=64, seq_length=20, dropprob=0.0, use_relu=False)
+SWEEPS = [
+  ('num_hid', [256, 512, 1024, 2048, 4096]),
+  ('input_dims', [256, 1024, 4096]),
+  ('batch_size', [16, 64, 256]),
+  ('seq_length', [10, 50]),
+  ('dropprob', [0.0, 0.25]),
+  ('use_relu', [False, True]),
+]
+QUICK_BASE = dict(num_hid=256, input_dims=256, batch_size=32, seq_length=10, dropprob=0.0, use_relu=False)
+QUICK_SWEEPS = [
+  ('num_hid', [256, 512]),
+  ('dropprob', [0.0, 0.25]),
+  ('use_relu', [False, True]),
+]
+PHASES = ['fprop', 'bprop', 'update']
+NUM_REPEATS = 3
+REGRESSION_TOLERANCE = 0.1
+
+def GetConfigs(base, sweeps):
+  configs = []
+  for key, values in sweeps:
+    for value in values:
+      config = dict(base)
+      config[key] = value
+      if config not in configs:
+        configs.append(config)
+  return configs
+
+def GetName(config):
+  return 'hid%d_in%d_b%d_t%d_drop%g_%s' % (config['num_hid'], config['input_dims'], config['batch_size'],
+                                           config['seq_length'], config['dropprob'],
+                                           'relu' if config['use_relu'] else 'tanh')
+
+# Floating point operations of the matrix products in each phase, per timestep
+# for fprop and bprop. Bprop computes the derivs wrt the previous state and the
+# input and the gradients of w_dense and w_input.
+def GetFlops(config):
+  b, n, d = config['batch_size'], config['num_hid'], config['input_dims']
+  fprop = 2.0 * b * 4 * n * (n + d)
+  num_params = 4 * n * (n + d) + 7 * n
+  return {'fprop': fprop, 'bprop': 2 * fprop, 'update': 6.0 * num_params}
+
+def MakeLSTM(config):
+  lstm_pb = config_pb2.LSTM()
+  lstm_pb.name = 'bench'
+  lstm_pb.num_hid = config['num_hid']
+  lstm_pb.has_input = True
+  lstm_pb.input_dims = config['input_dims']
+  lstm_pb.use_relu = config['use_relu']
+  lstm_pb.input_dropprob = config['dropprob']
+  for param in [lstm_pb.w_dense, lstm_pb.w_diag, lstm_pb.b, lstm_pb.w_input]:
+    param.init_type = config_pb2.Param.UNIFORM
+    param.scale = 0.01
+    param.epsilon = 0.001
+    param.momentum = 0.9
+  return lstm.LSTM(lstm_pb)
+
+# The largest resident set size of the process so far.
+def GetPeakMemoryMB():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# Times each phase NUM_REPEATS times after one warm up and keeps the fastest.
+def Run(config):
+  np.random.seed(42)
+  cm.CUDAMatrix.init_random(42)
+  batch_size, seq_length = config['batch_size'], config['seq_length']
+  layer = MakeLSTM(config)
+  layer.SetBatchSize(batch_size, seq_length)
+  v = cm.CUDAMatrix(np.random.rand(batch_size, seq_length * config['input_dims']).astype(np.float32))
+  v_deriv = cm.empty(v.shape)
+  frames = [v.col_slice(t * config['input_dims'], (t+1) * config['input_dims']) for t in xrange(seq_length)]
+  frame_derivs = [v_deriv.col_slice(t * config['input_dims'], (t+1) * config['input_dims']) for t in xrange(seq_length)]
+  param_buffer = ParamBuffer([param for _, param in layer.GetParams()])
+
+  times = dict((phase, []) for phase in PHASES)
+  peak_memory_increase = dict((phase, 0.0) for phase in PHASES)
+  for ii in xrange(NUM_REPEATS + 1):
+    layer.Reset()
+    v_deriv.assign(0)
+    peak_memory = GetPeakMemoryMB()
+    start = time.time()
+    for t in xrange(seq_length):
+      layer.Fprop(input_frame=frames[t], train=True)
+    times['fprop'].append(time.time() - start)
+    peak_memory_increase['fprop'] += GetPeakMemoryMB() - peak_memory
+
+    # the deriv of the last hidden state, as the layer above would send it
+    layer.GetCurrentHiddenDeriv().assign(1)
+    peak_memory = GetPeakMemoryMB()
+    start = time.time()
+    for t in xrange(seq_length-1, -1, -1):
+      layer.BpropAndOutp(input_frame=frames[t], input_deriv=frame_derivs[t])
+    times['bprop'].append(time.time() - start)
+    peak_memory_increase['bprop'] += GetPeakMemoryMB() - peak_memory
+
+    peak_memory = GetPeakMemoryMB()
+    start = time.time()
+    param_buffer.Update()
+    times['update'].append(time.time() - start)
+    peak_memory_increase['update'] += GetPeakMemoryMB() - peak_memory
+
+  flops = GetFlops(config)
+  result = {'config': config, 'peak_memory_mb': GetPeakMemoryMB()}
+  for phase in PHASES:
+    t = min(times[phase][1:])
+    steps = 1 if phase == 'update' else seq_length
+    result[phase] = {
+      'seconds': t,
+      'timesteps_per_sec': steps / t,
+      'gflops': flops[phase] * steps / t / 1e9,
+      'peak_memory_increase_mb': peak_memory_increase[phase],
+    }
+  return result
+
+def RunInSubprocess(config):
+  proc = subprocess.Popen([sys.executable, __file__, '--run', json.dumps(config)], stdout=subprocess.PIPE)
+  out, _ = proc.communicate()
+  if proc.returncode != 0:
+    raise Exception('Benchmark of %s failed.' % GetName(config))
+  return json.loads(out.strip().split('\n')[-1])
+
+def Compare(results, baseline):
+  regressions = 0
+  for name in sorted(results):
+    if name not in baseline:
+      continue
+    line = []
+    for phase in PHASES:
+      ratio = results[name][phase]['timesteps_per_sec'] / baseline[name][phase]['timesteps_per_sec']
+      mark = ''
+      if ratio < 1 - REGRESSION_TOLERANCE:
+        mark = ' REGRESSION'
+        regressions += 1
+      line.append('%s %.2fx%s' % (phase, ratio, mark))
+    print '%-40s %s' % (name, ' '.join(line))
+  return regressions
+
+def main():
+  if sys.argv[1] == '--run':
+    print json.dumps(Run(json.loads(sys.argv[2])))
+    return 0
+  args = [a for a in sys.argv[1:] if a != '--quick']
+  if '--quick' in sys.argv:
+    configs = GetConfigs(QUICK_BASE, QUICK_SWEEPS)
+  else:
+    configs = GetConfigs(BASE, SWEEPS)
+
+  results = {}
+  for config in configs:
+    name = GetName(config)
+    results[name] = RunInSubprocess(config)
+    print '%-40s %s peak %.0f MB' % (name, ' '.join('%s %.1f steps/s %.2f GFLOP/s +%.0f MB' % (
+      phase, results[name][phase]['timesteps_per_sec'], results[name][phase]['gflops'],
+      results[name][phase]['peak_memory_increase_mb']) for phase in PHASES), results[name]['peak_memory_mb'])
+  with open(args[0], 'w') as f:
+    json.dump(results, f, indent=2, sort_keys=True)
+  print 'Results written to %s' % args[0]
+
+  if len(args) > 1:
+    with open(args[1], 'r') as f:
+      baseline = json.load(f)
+    print 'Compared to %s' % args[1]
+    if Compare(results, baseline) > 0:
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,57 @@
+"""Converts a LABELLED or UNLABELLED dataset into a frame store.
+
+  python convert_to_frame_store.py <data pbtxt> <output prefix> [uint8|float16]
+
+Writes <output prefix>.frames.npy and <output prefix>.index.npy, which can be
+used with dataset_type: FRAME_STORE and data_file: "<output prefix>". Frames
+are stored as uint8 if they are uint8 already, as float16 otherwise, unless
+given. All videos are converted, video_ids_file still applies when reading.
+"""
+
+from data_handler import *
+
+def main():
+  data_pb = ReadDataProto(sys.argv[1])
+  prefix = sys.argv[2]
+
+  # one (file, dataset, start, end) per video
+  num_frames = [int(line.strip()) for line in open(data_pb.num_frames_file)]
+  if data_pb.dataset_type == config_pb2.Data.LABELLED:
+    f = h5py.File(data_pb.data_file, 'r')
+    source_dtype = f[data_pb.dataset_name].dtype
+    frame_size = f[data_pb.dataset_name].shape[1]
+    f.close()
+    labels = [int(line.strip()) for line in open(data_pb.labels_file)]
+    starts = np.concatenate([[0], np.cumsum(num_frames)[:-1]])
+    videos = [(data_pb.data_file, s, s + n) for s, n in zip(starts, num_frames)]
+  elif data_pb.dataset_type == config_pb2.Data.UNLABELLED:
+    filenames = [line.strip() for line in open(data_pb.data_file)]
+    f = h5py.File(filenames[0], 'r')
+    source_dtype = f[data_pb.dataset_name].dtype
+    frame_size = f[data_pb.dataset_name].shape[1]
+    f.close()
+    labels = None
+    videos = [(filename, 0, n) for filename, n in zip(filenames, num_frames)]
+  else:
+    raise Exception('Only LABELLED and UNLABELLED datasets can be converted.')
+  assert len(videos) == len(num_frames)
+
+  if len(sys.argv) > 3:
+    dtype = np.dtype(sys.argv[3])
+  else:
+    dtype = np.dtype(np.uint8) if source_dtype == np.uint8 else np.dtype(np.float16)
+
+  frames, index = FrameStore.Create(prefix, num_frames, frame_size, dtype, labels=labels)
+  files = H5FileCache(1)
+  for v, (filename, start, end) in enumerate(videos):
+    sys.stdout.write('\r%d of %d' % (v+1, len(videos)))
+    sys.stdout.flush()
+    data = files.Get(filename, data_pb.dataset_name)
+    frames[index['start'][v]:index['start'][v] + end - start] = data[start:end]
+  files.Close()
+  frames.flush()
+  sys.stdout.write('\n')
+  print 'Wrote %d frames of %d videos to %s' % (frames.shape[0], len(videos), prefix)
+
+if __name__ == '__main__':
+  main()
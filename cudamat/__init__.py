@@ -1 +1,7 @@
-from cudamat import *
+import os
+
+# CUDAMAT_BACKEND=cpu selects the NumPy/BLAS implementation of the same API.
+if os.environ.get('CUDAMAT_BACKEND', 'gpu') == 'cpu':
+  from npmat import *
+else:
+  from cudamat import *
@@ -3279,6 +3279,71 @@ int lstm_outp(cudamat* s_in, cudamat* s_out, cudamat* d_out, cudamat* dw_dense,
     return CUDA_ERROR;
   return 0;
 }
+
+// dw_history = momentum * dw_history - eps * (dw + l2_decay * w), clipped to
+// [-gradient_clip, gradient_clip] if gradient_clip > 0, and w += dw_history.
+int momentum_update(cudamat* w, cudamat* dw, cudamat* dw_history, float eps, float momentum, float l2_decay, float gradient_clip) {
+  int len = w->size[0] * w->size[1];
+
+  if (!w->on_device || !dw->on_device || !dw_history->on_device)
+    return ERROR_NOT_ON_DEVICE;
+
+  if (w->size[0] != dw->size[0] || w->size[1] != dw->size[1] ||
+      w->size[0] != dw_history->size[0] || w->size[1] != dw_history->size[1])
+    return ERROR_INCOMPATIBLE_DIMENSIONS;
+
+  kMomentumUpdate<<<NUM_VECTOR_OP_BLOCKS,NUM_VECTOR_OP_THREADS_PER_BLOCK>>>(
+      w->data_device, dw->data_device, dw_history->data_device, eps, momentum, l2_decay, gradient_clip, len);
+
+  if (checkCUDAError())
+    return CUDA_ERROR;
+  return 0;
+}
+
+// dw_sqr_history = decay * dw_sqr_history + (1 - decay) * g^2 with
+// g = dw + l2_decay * w, and w -= eps * g / (sqrt(dw_sqr_history) + damping),
+// the step clipped to [-gradient_clip, gradient_clip] if gradient_clip > 0.
+int rmsprop_update(cudamat* w, cudamat* dw, cudamat* dw_sqr_history, float eps, float decay, float l2_decay, float gradient_clip, float damping) {
+  int len = w->size[0] * w->size[1];
+
+  if (!w->on_device || !dw->on_device || !dw_sqr_history->on_device)
+    return ERROR_NOT_ON_DEVICE;
+
+  if (w->size[0] != dw->size[0] || w->size[1] != dw->size[1] ||
+      w->size[0] != dw_sqr_history->size[0] || w->size[1] != dw_sqr_history->size[1])
+    return ERROR_INCOMPATIBLE_DIMENSIONS;
+
+  kRMSPropUpdate<<<NUM_VECTOR_OP_BLOCKS,NUM_VECTOR_OP_THREADS_PER_BLOCK>>>(
+      w->data_device, dw->data_device, dw_sqr_history->data_device, eps, decay, l2_decay, gradient_clip, damping, len);
+
+  if (checkCUDAError())
+    return CUDA_ERROR;
+  return 0;
+}
+
+// dw_history and dw_sqr_history are moving averages of g = dw + l2_decay * w
+// and g^2, w -= eps * dw_history / (sqrt(dw_sqr_history) + damping), the step
+// clipped to [-gradient_clip, gradient_clip] if gradient_clip > 0. eps is
+// expected to include the bias correction.
+int adam_update(cudamat* w, cudamat* dw, cudamat* dw_history, cudamat* dw_sqr_history, float eps, float beta1, float beta2, float l2_decay, float gradient_clip, float damping) {
+  int len = w->size[0] * w->size[1];
+
+  if (!w->on_device || !dw->on_device || !dw_history->on_device || !dw_sqr_history->on_device)
+    return ERROR_NOT_ON_DEVICE;
+
+  if (w->size[0] != dw->size[0] || w->size[1] != dw->size[1] ||
+      w->size[0] != dw_history->size[0] || w->size[1] != dw_history->size[1] ||
+      w->size[0] != dw_sqr_history->size[0] || w->size[1] != dw_sqr_history->size[1])
+    return ERROR_INCOMPATIBLE_DIMENSIONS;
+
+  kAdamUpdate<<<NUM_VECTOR_OP_BLOCKS,NUM_VECTOR_OP_THREADS_PER_BLOCK>>>(
+      w->data_device, dw->data_device, dw_history->data_device, dw_sqr_history->data_device,
+      eps, beta1, beta2, l2_decay, gradient_clip, damping, len);
+
+  if (checkCUDAError())
+    return CUDA_ERROR;
+  return 0;
+}
 #ifdef __cplusplus
 }
 #endif
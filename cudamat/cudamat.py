@@ -707,7 +707,7 @@ class CUDAMatrix(object):
         if err_code:
             raise generate_exception(err_code)
 
-        return self
+        return target
 
     def sample_bernoulli_tanh(self, target=None):
         """
@@ -719,7 +719,7 @@ class CUDAMatrix(object):
         if err_code:
             raise generate_exception(err_code)
 
-        return self
+        return target
 
     def sample_poisson(self, target=None):
         """
@@ -732,7 +732,7 @@ class CUDAMatrix(object):
         if err_code:
             raise generate_exception(err_code)
 
-        return self
+        return target
 
     def sample_gaussian(self, mult=1.0, target=None):
         """
@@ -744,7 +744,7 @@ class CUDAMatrix(object):
         if err_code:
             raise generate_exception(err_code)
 
-        return self
+        return target
 
     def perturb_energy_for_softmax_sampling(self, target=None):
         """
@@ -756,7 +756,7 @@ class CUDAMatrix(object):
         if err_code:
             raise generate_exception(err_code)
 
-        return self
+        return target
 
     def perturb_prob_for_softmax_sampling(self, target=None):
         """
@@ -768,7 +768,7 @@ class CUDAMatrix(object):
         if err_code:
             raise generate_exception(err_code)
 
-        return self
+        return target
 
 
     def add_col_vec(self, vec, target = None):
@@ -2253,6 +2253,51 @@ def lstm_outp(s_in, s_out, d_out, dw_dense, dw_diag, db, init=False):
   if err_code:
     raise generate_exception(err_code)
 
+def momentum_update(w, dw, dw_history, eps, momentum, l2_decay=0., gradient_clip=0.):
+  """
+  One momentum step in a single pass: dw_history = momentum * dw_history -
+  eps * (dw + l2_decay * w), clipped to [-gradient_clip, gradient_clip] if
+  gradient_clip > 0, then w += dw_history. dw may be overwritten.
+  """
+  assert dw.shape == w.shape
+  assert dw_history.shape == w.shape
+  err_code = _cudamat.momentum_update(w.p_mat, dw.p_mat, dw_history.p_mat, ct.c_float(eps), ct.c_float(momentum),
+                                      ct.c_float(l2_decay), ct.c_float(gradient_clip))
+  if err_code:
+    raise generate_exception(err_code)
+
+def rmsprop_update(w, dw, dw_sqr_history, eps, decay, l2_decay=0., gradient_clip=0., damping=1e-8):
+  """
+  One RMSProp step in a single pass: with g = dw + l2_decay * w,
+  dw_sqr_history = decay * dw_sqr_history + (1 - decay) * g^2 and
+  w -= eps * g / (sqrt(dw_sqr_history) + damping), the step clipped to
+  [-gradient_clip, gradient_clip] if gradient_clip > 0. dw may be overwritten.
+  """
+  assert dw.shape == w.shape
+  assert dw_sqr_history.shape == w.shape
+  err_code = _cudamat.rmsprop_update(w.p_mat, dw.p_mat, dw_sqr_history.p_mat, ct.c_float(eps), ct.c_float(decay),
+                                     ct.c_float(l2_decay), ct.c_float(gradient_clip), ct.c_float(damping))
+  if err_code:
+    raise generate_exception(err_code)
+
+def adam_update(w, dw, dw_history, dw_sqr_history, eps, beta1, beta2, l2_decay=0., gradient_clip=0., damping=1e-8):
+  """
+  One Adam step in a single pass: with g = dw + l2_decay * w,
+  dw_history = beta1 * dw_history + (1 - beta1) * g,
+  dw_sqr_history = beta2 * dw_sqr_history + (1 - beta2) * g^2 and
+  w -= eps * dw_history / (sqrt(dw_sqr_history) + damping), the step clipped
+  to [-gradient_clip, gradient_clip] if gradient_clip > 0. eps must include
+  the bias correction. dw may be overwritten.
+  """
+  assert dw.shape == w.shape
+  assert dw_history.shape == w.shape
+  assert dw_sqr_history.shape == w.shape
+  err_code = _cudamat.adam_update(w.p_mat, dw.p_mat, dw_history.p_mat, dw_sqr_history.p_mat, ct.c_float(eps),
+                                  ct.c_float(beta1), ct.c_float(beta2), ct.c_float(l2_decay),
+                                  ct.c_float(gradient_clip), ct.c_float(damping))
+  if err_code:
+    raise generate_exception(err_code)
+
 def cuda_sync_threads():
     _cudamat.cuda_sync_threads()
 
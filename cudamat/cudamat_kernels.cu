@@ -1972,3 +1972,48 @@ __global__ void kLSTMOutp(float* s_in, float* s_out, float* d_out, float* dw_dia
     sum_vals[threadIdx.x] = dbo;reduceToSumLocal32(sum_vals, threadIdx.x); __syncthreads(); if (threadIdx.x == 0) db[lstm_id + num_lstms * 3] += sum_vals[0];
   }
 }
+
+__global__ void kMomentumUpdate(float* w, float* dw, float* dw_history, float eps, float momentum, float l2_decay, float gradient_clip, unsigned int len) {
+  const unsigned int idx = blockIdx.x * blockDim.x + threadIdx.x;
+  const unsigned int numThreads = blockDim.x * gridDim.x;
+  for (unsigned int i = idx; i < len; i += numThreads) {
+    float h = momentum * dw_history[i] - eps * (dw[i] + l2_decay * w[i]);
+    if (gradient_clip > 0) {
+      h = h > gradient_clip ? gradient_clip : (h < -gradient_clip ? -gradient_clip : h);
+    }
+    dw_history[i] = h;
+    w[i] += h;
+  }
+}
+
+__global__ void kRMSPropUpdate(float* w, float* dw, float* dw_sqr_history, float eps, float decay, float l2_decay, float gradient_clip, float damping, unsigned int len) {
+  const unsigned int idx = blockIdx.x * blockDim.x + threadIdx.x;
+  const unsigned int numThreads = blockDim.x * gridDim.x;
+  for (unsigned int i = idx; i < len; i += numThreads) {
+    float g = dw[i] + l2_decay * w[i];
+    float v = decay * dw_sqr_history[i] + (1 - decay) * g * g;
+    float h = eps * g / (sqrt(v) + damping);
+    if (gradient_clip > 0) {
+      h = h > gradient_clip ? gradient_clip : (h < -gradient_clip ? -gradient_clip : h);
+    }
+    dw_sqr_history[i] = v;
+    w[i] -= h;
+  }
+}
+
+__global__ void kAdamUpdate(float* w, float* dw, float* dw_history, float* dw_sqr_history, float eps, float beta1, float beta2, float l2_decay, float gradient_clip, float damping, unsigned int len) {
+  const unsigned int idx = blockIdx.x * blockDim.x + threadIdx.x;
+  const unsigned int numThreads = blockDim.x * gridDim.x;
+  for (unsigned int i = idx; i < len; i += numThreads) {
+    float g = dw[i] + l2_decay * w[i];
+    float m = beta1 * dw_history[i] + (1 - beta1) * g;
+    float v = beta2 * dw_sqr_history[i] + (1 - beta2) * g * g;
+    float h = eps * m / (sqrt(v) + damping);
+    if (gradient_clip > 0) {
+      h = h > gradient_clip ? gradient_clip : (h < -gradient_clip ? -gradient_clip : h);
+    }
+    dw_history[i] = m;
+    dw_sqr_history[i] = v;
+    w[i] -= h;
+  }
+}
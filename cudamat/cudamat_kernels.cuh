@@ -186,4 +186,7 @@ __global__ void kLogisticCorrectNormalized(float* mat, float* targets, float* ou
 __global__ void kLSTMFprop(float *s_in, float* s_out, float* w_diag, float* b, int numcases, int num_lstms, bool init, bool use_relu);
 __global__ void kLSTMBprop(float *s_in, float* s_out, float* d_in, float* d_out, float* w_diag, int numcases, int num_lstms, bool init, bool use_relu);
 __global__ void kLSTMOutp(float* s_in, float* s_out, float* d_out, float* dw_diag, float* db, int numcases, int num_lstms, bool init);
+__global__ void kMomentumUpdate(float* w, float* dw, float* dw_history, float eps, float momentum, float l2_decay, float gradient_clip, unsigned int len);
+__global__ void kRMSPropUpdate(float* w, float* dw, float* dw_sqr_history, float eps, float decay, float l2_decay, float gradient_clip, float damping, unsigned int len);
+__global__ void kAdamUpdate(float* w, float* dw, float* dw_history, float* dw_sqr_history, float eps, float beta1, float beta2, float l2_decay, float gradient_clip, float damping, unsigned int len);
 #endif
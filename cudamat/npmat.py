@@ -0,0 +1,930 @@
+"""
+CPU implementation of the CUDAMatrix API on top of NumPy.
+
+Matrices are stored as float32 arrays in FORTRAN order, exactly like the
+device layout used by cudamat, so col_slice returns a view that shares memory
+with its parent and every GEMM can be handed to BLAS without a copy.
+"""
+import numpy as np
+from scipy.linalg import blas
+
+class CUDAMatException(Exception):
+    pass
+
+def reformat(array):
+    """
+    Returns array as a float32 array in FORTRAN order.
+    """
+
+    return np.array(array, dtype=np.float32, order='F')
+
+def _as_array(val):
+    if isinstance(val, CUDAMatrix):
+        return val.numpy_array
+    return val
+
+class TransposedCUDAMatrix(object):
+    def __init__(self, mat):
+        self.mat = mat
+
+    @property
+    def shape(self):
+        return (self.mat.shape[1], self.mat.shape[0])
+
+class CUDAMatrix(object):
+    """
+    A CUDAMatrix object represents a matrix of single precision floating point
+    numbers in host memory.
+    """
+
+    rnd_state = np.random.RandomState(0)
+
+    def overwrite(self, array, copy_to_device=True):
+        """Overwrites self with array."""
+        assert type(array) == np.ndarray, 'array must be a np.ndarray.'
+        if array.shape == self.shape:
+            self.numpy_array[...] = array
+        else:
+            self.numpy_array = reformat(array)
+
+    def __init__(self, array, copy_to_device = True, transpose = False, shape=None):
+        """
+        Initializes a new matrix object. If array is a numpy ndarray, it is
+        copied into a new float32 FORTRAN ordered array. Otherwise array must
+        already be such an array (typically a view of another matrix) and
+        it is used as is.
+        """
+
+        if isinstance(array, np.ndarray) and array.dtype == np.float32 and \
+           array.ndim == 2 and array.flags.f_contiguous and not copy_to_device:
+            self.numpy_array = array
+        elif transpose:
+            self.numpy_array = reformat(array.T)
+        else:
+            self.numpy_array = reformat(array)
+
+    @staticmethod
+    def init_random(seed = 0):
+        """
+        Initialize and seed the random number generator.
+        """
+
+        CUDAMatrix.rndInitialized = 1
+        CUDAMatrix.rnd_state = np.random.RandomState(seed)
+
+    @property
+    def shape(self):
+        return self.numpy_array.shape
+
+    @property
+    def T(self):
+        return TransposedCUDAMatrix(self)
+
+    def set_shape4d(self, shape):
+        return self
+
+    def reshape(self, shape):
+        """
+        Reshapes self to have the given shape. The number of elements cannot
+        change as this only changes how the contents are interpreted.
+        """
+        self.numpy_array = self.numpy_array.reshape(shape, order='F')
+        return self
+
+    def asarray(self):
+        """
+        Copies the matrix to a new ndarray and returns it.
+        """
+
+        return reformat(self.numpy_array)
+
+    def copy_to_device(self):
+        pass
+
+    def copy_to_host(self):
+        pass
+
+    def free_device_memory(self):
+        pass
+
+    def assign(self, val):
+        """Assign val to self, where val can be a scalar or a CUDAMatrix
+        with the same dimensions as self. """
+
+        if isinstance(val, CUDAMatrix):
+            self.numpy_array[...] = val.numpy_array
+        elif isinstance(val, (int, float)):
+            self.numpy_array.fill(val)
+        else:
+            raise ValueError, "Assigned value must be of type CUDAMatrix, int, or float."
+
+        return self
+
+    def write_value(self, row, col, val):
+        """Assign val to self[row, col], where val is a scalar. """
+
+        self.numpy_array[row, col] = val
+        return self
+
+    def read_value(self, row, col):
+        """Return self[row, col]. """
+
+        return float(self.numpy_array[row, col])
+
+    def col_slice(self, first_col, last_col):
+        return CUDAMatrix(self.numpy_array[:, first_col:last_col], copy_to_device=False)
+
+    def slice(self, first_col, last_col):
+        if self.shape[1] == 1:
+            return CUDAMatrix(self.numpy_array[first_col:last_col, :], copy_to_device=False)
+        return self.col_slice(first_col, last_col)
+
+    def get_col_slice(self, first_col, last_col, target = None):
+        col_slice = self.slice(first_col, last_col)
+
+        if target:
+            target.assign(col_slice)
+            return target
+        else:
+            return col_slice
+
+    def set_col_slice(self, first_col, last_col, mat):
+        self.slice(first_col, last_col).assign(mat)
+
+        return self
+
+    def get_row_slice(self, start, end, target = None):
+        """
+        Get the rows with indices start through end. If target is not provided
+        memory for a new matrix will be allocated.
+        """
+
+        if not target:
+            target = empty((end-start, self.shape[1]))
+
+        target.numpy_array[...] = self.numpy_array[start:end, :]
+        return target
+
+    def set_row_slice(self, start, end, mat):
+        """
+        Assign the contents of mat to the rows with indices start through end.
+        """
+
+        self.numpy_array[start:end, :] = mat.numpy_array
+        return self
+
+    def transpose(self, target = None):
+        """
+        Return a transposed copy of the matrix.
+        """
+        if not target:
+            target = empty((self.shape[1], self.shape[0]))
+
+        target.numpy_array[...] = self.numpy_array.T
+        return target
+
+    def fill_with_rand(self):
+        """
+        Fill matrix with random numbers drawn from the uniform distribution
+        over the (0,1) interval.
+        """
+
+        self.numpy_array[...] = CUDAMatrix.rnd_state.uniform(size=self.shape)
+        return self
+
+    def fill_with_randn(self):
+        """
+        Fill matrix with random numbers drawn from the standard normal
+        distribution.
+        """
+
+        self.numpy_array[...] = CUDAMatrix.rnd_state.standard_normal(size=self.shape)
+        return self
+
+    def dropout(self, dropprob, val=0.0, scale=1.0):
+        """
+        Drop entries in this matrix uniformly randomly with given probability
+        and set the dropped out unit to state val.
+        """
+        drop = CUDAMatrix.rnd_state.uniform(size=self.shape) < dropprob
+        self.numpy_array *= scale
+        self.numpy_array[drop] = val
+        return self
+
+    def sample_bernoulli(self, target=None):
+        """
+        Sample a bernoulli distribution. Choose 1 with probability given by entries of self, 0 otherwise.
+        """
+        if not target:
+          target = self
+        target.numpy_array[...] = CUDAMatrix.rnd_state.uniform(size=self.shape) < self.numpy_array
+        return target
+
+    def add_col_vec(self, vec, target = None):
+        """
+        Add vector vec to every column of the matrix. If a target is provided,
+        it is used to store the result instead of self.
+        """
+
+        if not target:
+            target = self
+
+        np.add(self.numpy_array, vec.numpy_array, out=target.numpy_array)
+        return target
+
+    def add_row_vec(self, vec, target = None):
+        """
+        Add vector vec to every row of the matrix. If a target is provided,
+        it is used to store the result instead of self.
+        """
+
+        if not target:
+            target = self
+
+        np.add(self.numpy_array, vec.numpy_array, out=target.numpy_array)
+        return target
+
+    def mult_by_col(self, vec, target = None):
+        """
+        Multiply vector vec into every column of the matrix. If a target is
+        provided, it is used to store the result instead of self.
+        """
+
+        if not target:
+            target = self
+
+        np.multiply(self.numpy_array, vec.numpy_array, out=target.numpy_array)
+        return target
+
+    def mult_by_row(self, vec, target = None):
+        """
+        Multiply vector vec into every row of the matrix. If a target is
+        provided, it is used to store the result instead of self.
+        """
+
+        if not target:
+            target = self
+
+        np.multiply(self.numpy_array, vec.numpy_array, out=target.numpy_array)
+        return target
+
+    def sum(self, axis=None, target = None, mult=1.0):
+        """
+        Sum the matrix along the given dimension, where 0 represents the leading
+        dimension and 1 represents the non-leading dimension. If None, the sum
+        of all elements is returned. If a target is not prvided, a new vector is
+        created for storing the result.
+        """
+        if axis is None:
+            return float(self.numpy_array.sum(dtype=np.float64)) * mult
+        else:
+            return sum(self, axis, target, mult)
+
+    def add_sums(self, mat, axis, mult = 1.):
+        """
+        Add a multiple of the sums of the matrix mat along the given dimension
+        to self.
+        """
+
+        s = mat.numpy_array.sum(axis=axis, keepdims=True)
+        if mult != 1.:
+            s *= mult
+        self.numpy_array += s
+        return self
+
+    def upper_bound(self, val, target = None):
+        """
+        Perform the operation target = (self > val) ? val:self, where val can be a matrix or a scalar.
+        """
+        if not target:
+            target = self
+
+        np.minimum(self.numpy_array, _as_array(val), out=target.numpy_array)
+        return target
+
+    def upper_bound_mod(self, val, target = None):
+        """
+        Perform the operation target = (|self| > val) ? sign(self)*val:self, where val is a scalar.
+        """
+        if not target:
+            target = self
+
+        np.clip(self.numpy_array, -val, val, out=target.numpy_array)
+        return target
+
+    def lower_bound(self, val, target = None):
+        """
+        Perform the operation target = (self < val) ? val:self, where val can be a matrix or a scalar.
+        """
+        if not target:
+            target = self
+
+        np.maximum(self.numpy_array, _as_array(val), out=target.numpy_array)
+        return target
+
+    def apply_softmax_row_major(self, num_slices = None):
+        """
+        Apply the softmax activation function to every row.
+        """
+        if num_slices is None:
+          num_slices = self.shape[1]
+        a = self.numpy_array.reshape((-1, num_slices), order='F')
+        a -= a.max(axis=1, keepdims=True)
+        np.exp(a, out=a)
+        a /= a.sum(axis=1, keepdims=True)
+        return self
+
+    def get_softmax_correct_row_major(self, labels, target):
+        """
+        target[i] = 1, iff labels[i] is correctly predicted; 0 otherwise.
+        """
+        assert labels.shape == (self.shape[0], 1), 'Labels shape %d-%d, softmax shape %d-1' % (labels.shape[0], labels.shape[1])
+        assert target.shape == labels.shape
+        pred = self.numpy_array.argmax(axis=1)
+        target.numpy_array[:, 0] = pred == labels.numpy_array[:, 0].astype(np.int32)
+        return target
+
+    def apply_softmax_grad_row_major(self, labels, target = None):
+        """
+        Apply softmax derivative, where labels are the correct labels.
+        """
+        if not target:
+            target = self
+
+        assert labels.shape == (self.shape[0], 1)
+        assert target.shape == self.shape
+        target.numpy_array[...] = self.numpy_array
+        rows = np.arange(self.shape[0])
+        target.numpy_array[rows, labels.numpy_array[:, 0].astype(np.int32)] -= 1
+        return target
+
+    def apply_sigmoid(self, target = None):
+        """
+        Apply the logistic sigmoid to each element of the matrix.
+        """
+
+        return sigmoid(self, target)
+
+    def apply_tanh(self, target = None):
+        """
+        Apply the tanh to each element of the matrix.
+        """
+
+        return tanh(self, target)
+
+    def apply_relu_squash(self, target = None, lambdaa=1.0):
+        """
+        Apply 2 / (1 + exp(-lambda * x)) - 1 to each element of the matrix.
+        """
+
+        if not target:
+            target = self
+
+        a = target.numpy_array
+        np.multiply(self.numpy_array, -lambdaa, out=a)
+        np.exp(a, out=a)
+        a += 1
+        np.divide(2, a, out=a)
+        a -= 1
+        return target
+
+    def apply_rectified_linear_deriv(self, val, target = None):
+        """
+        Apply rectified linear derivative, where val is the activation of the units.
+        """
+
+        if not target:
+            target = self
+
+        np.multiply(self.numpy_array, val.numpy_array > 0, out=target.numpy_array)
+        return target
+
+    def apply_logistic_deriv(self, val, target = None):
+        """
+        Apply logistic derivative, where val is the activation of logistic units.
+        """
+
+        if not target:
+            target = self
+
+        v = val.numpy_array
+        np.multiply(self.numpy_array, v * (1 - v), out=target.numpy_array)
+        return target
+
+    def apply_tanh_deriv(self, val, target = None):
+        """
+        Apply tanh derivative, where val is the activation of the units.
+        """
+
+        if not target:
+            target = self
+
+        v = val.numpy_array
+        np.multiply(self.numpy_array, 1 - v * v, out=target.numpy_array)
+        return target
+
+    def dot(self, mat2, mult=1.0, target = None):
+        """
+        Multiply the matrix by mat2 from the right and multiply by scalar mult.
+        """
+
+        return dot(self, mat2, mult, target)
+
+    def add_dot(self, m1, m2, mult=1.0):
+        """
+        Add the dot product of m1 and m2 to the matrix.
+        """
+
+        return dot(m1, m2, mult, self, scale_targets=1.0)
+
+    def add_mult(self, mat2, mult = 1.):
+        """
+        Add multiple of mat2 to the matrix.
+        """
+
+        blas_axpy(mat2.numpy_array, self.numpy_array, mult)
+        return self
+
+    def subtract_mult(self, mat2, mult = 1.):
+        """
+        Subtract a multiple of mat2 from the matrix.
+        """
+
+        return self.add_mult(mat2, -1. * mult)
+
+    def add(self, val, target = None):
+        """Add val to self, where val can be a scalar or a CUDAMatrix with the
+        same dimensions as self. """
+
+        if not target:
+            target = self
+
+        np.add(self.numpy_array, _as_array(val), out=target.numpy_array)
+        return target
+
+    def subtract(self, val, target = None):
+        """Subtract val from self, where val can be a scalar or a CUDAMatrix with
+        the same dimensions as self. """
+
+        if not target:
+            target = self
+
+        np.subtract(self.numpy_array, _as_array(val), out=target.numpy_array)
+        return target
+
+    def divide(self, val, target = None):
+        """Divide self by val, where val can be a scalar or a CUDAMatrix with the
+        same dimensions as self. """
+
+        if not target:
+            target = self
+
+        np.divide(self.numpy_array, _as_array(val), out=target.numpy_array)
+        return target
+
+    def mult(self, val, target = None, scale_targets=0.0):
+        """Multiply self by val, where val can be a scalar or a CUDAMatrix with
+        the same dimensions as self. """
+
+        if not target:
+            target = self
+
+        if scale_targets == 0:
+            np.multiply(self.numpy_array, _as_array(val), out=target.numpy_array)
+        else:
+            target.numpy_array *= scale_targets
+            target.numpy_array += self.numpy_array * _as_array(val)
+        return target
+
+    def euclid_norm(self):
+        return float(np.sqrt(np.dot(self.numpy_array.ravel(order='K'),
+                                    self.numpy_array.ravel(order='K'))))
+
+def blas_axpy(x, y, mult):
+    """
+    y += mult * x, in place.
+    """
+    if x.flags.f_contiguous and y.flags.f_contiguous:
+        blas.saxpy(x.ravel(order='F'), y.ravel(order='F'), a=mult)
+    else:
+        y += mult * x
+
+def empty(shape):
+    """
+    Creates and returns a new CUDAMatrix with the given shape.
+    """
+    if len(shape) == 2:
+      shape2d = shape
+    elif len(shape) == 4:
+      shape2d = (shape[0], shape[1] * shape[2] * shape[3])
+    elif len(shape) == 5:
+      shape2d = (shape[0], shape[1] * shape[2] * shape[3] * shape[4])
+    else:
+      raise Exception('Invalid shape.')
+
+    return CUDAMatrix(np.zeros(shape2d, dtype=np.float32, order='F'), copy_to_device=False)
+
+def empty_like(m):
+    """
+    Creates and returns a new CUDAMatrix with the shape same as that of m.
+    """
+    return empty(m.shape)
+
+def sum(mat, axis, target = None, mult=1.0):
+    """
+    Sum the matrix along the given dimension, where 0 represents the leading
+    dimension and 1 represents the non-leading dimension. If a target is
+    not prvided, a new vector is created for storing the result.
+    """
+
+    if not target:
+        if axis == 0:
+            target = empty((1, mat.shape[1]))
+        else:
+            target = empty((mat.shape[0], 1))
+
+    np.sum(mat.numpy_array, axis=axis, keepdims=True, out=target.numpy_array)
+    if mult != 1.0:
+        target.numpy_array *= mult
+    return target
+
+def _gemm_operand(m):
+    if isinstance(m, TransposedCUDAMatrix):
+        return m.mat.numpy_array, 1
+    return m.numpy_array, 0
+
+def dot(m1, m2, mult=1.0, target = None, scale_targets=0.0):
+    """
+    Find the dot product between m1 and m2. Either of them may be
+    transposed with .T, which is passed on to the BLAS sgemm call.
+    """
+
+    if not target:
+        target = empty((m1.shape[0], m2.shape[1]))
+
+    a, trans_a = _gemm_operand(m1)
+    b, trans_b = _gemm_operand(m2)
+    c = target.numpy_array
+    res = blas.sgemm(mult, a, b, beta=scale_targets, c=c,
+                     trans_a=trans_a, trans_b=trans_b, overwrite_c=1)
+    if res is not c:
+        c[...] = res
+
+    return target
+
+def vdot(m1, m2):
+    """
+    Compute the vector dot product of matrices m1 and m2.
+    """
+
+    return float(np.vdot(m1.numpy_array, m2.numpy_array))
+
+def sigmoid(mat, target = None):
+    """
+    Apply the logistic sigmoid to each element of the matrix mat.
+    """
+
+    if not target:
+        target = mat
+
+    a = target.numpy_array
+    np.negative(mat.numpy_array, out=a)
+    np.exp(a, out=a)
+    a += 1
+    np.reciprocal(a, out=a)
+    return target
+
+def tanh(mat, target = None):
+    """
+    Apply the tanh to each element of the matrix mat.
+    """
+
+    if not target:
+        target = mat
+
+    np.tanh(mat.numpy_array, out=target.numpy_array)
+    return target
+
+def exp(mat, target = None):
+    """
+    Apply the exponential function to each element of the matrix mat.
+    """
+
+    if not target:
+        target = mat
+
+    np.exp(mat.numpy_array, out=target.numpy_array)
+    return target
+
+def log(mat, tiny=0.0, target = None):
+    """
+    Find the natural logarithm of each element of the matrix mat.
+    """
+
+    if not target:
+        target = mat
+
+    np.add(mat.numpy_array, tiny, out=target.numpy_array)
+    np.log(target.numpy_array, out=target.numpy_array)
+    return target
+
+def sqrt(mat, target = None):
+    """
+    Compute the square root of each element of the matrix mat.
+    """
+
+    if not target:
+        target = mat
+
+    np.sqrt(mat.numpy_array, out=target.numpy_array)
+    return target
+
+def cross_entropy_bernoulli(mat, p, target = None, tiny=1e-10):
+    """
+    Compute -mat*log(p) - (1-mat).*log(1-p)
+    """
+
+    if not target:
+        target = mat
+
+    if not isinstance(p, CUDAMatrix):
+        raise ValueError, "Value must be of type CUDAMatrix."
+
+    m = mat.numpy_array
+    q = p.numpy_array
+    target.numpy_array[...] = -m * np.log(q + tiny) - (1 - m) * np.log(1 - q + tiny)
+    return target
+
+# Scratch space for the LSTM kernels, keyed by (numcases, num_lstms). Reused
+# across timesteps so that the elementwise part never allocates.
+_lstm_scratch = {}
+
+def _get_lstm_scratch(numcases, num_lstms):
+  key = (numcases, num_lstms)
+  if key not in _lstm_scratch:
+    _lstm_scratch[key] = (
+      [np.empty((numcases, num_lstms), dtype=np.float32, order='F') for i in xrange(3)],
+      np.empty((1, 4 * num_lstms), dtype=np.float32, order='F'))
+  return _lstm_scratch[key]
+
+def _sigmoid_inplace(x):
+  np.negative(x, out=x)
+  np.exp(x, out=x)
+  x += 1
+  np.reciprocal(x, out=x)
+
+def lstm_fprop(s_in, s_out, w_dense, w_diag, b, use_relu=False, init=False):
+  numcases, num_lstms_mult = s_in.shape
+  num_lstms = num_lstms_mult / 6
+  assert s_out.shape == s_in.shape
+  assert w_diag.shape == (1, 3 * num_lstms)
+  assert w_dense.shape == (4 * num_lstms, num_lstms)
+  assert b.shape == (1, 4 * num_lstms)
+
+  n = num_lstms
+  if not init:
+    # Fprop from previous hidden state to all gates.
+    dot(s_in.col_slice(0, n), w_dense.T, target=s_out.col_slice(2 * n, 6 * n), scale_targets=1.0)
+
+  (tmp, _, _), _ = _get_lstm_scratch(numcases, n)
+  s = s_out.numpy_array
+  w = w_diag.numpy_array
+  h, c, i, f, a, o = [s[:, k*n:(k+1)*n] for k in xrange(6)]
+  s[:, 2*n:] += b.numpy_array
+
+  if not init:
+    c_in = s_in.numpy_array[:, n:2*n]
+    np.multiply(c_in, w[:, :n], out=tmp)
+    i += tmp
+    np.multiply(c_in, w[:, n:2*n], out=tmp)
+    f += tmp
+  _sigmoid_inplace(s[:, 2*n:4*n])  # i and f are adjacent.
+  if use_relu:
+    np.maximum(a, 0, out=a)
+  else:
+    np.tanh(a, out=a)
+
+  np.multiply(i, a, out=c)
+  if not init:
+    np.multiply(c_in, f, out=tmp)
+    c += tmp
+
+  np.multiply(c, w[:, 2*n:], out=tmp)
+  o += tmp
+  _sigmoid_inplace(o)
+
+  if use_relu:
+    np.multiply(o, c, out=h)  # relu(c) = c, because c is always +ve here.
+  else:
+    np.tanh(c, out=h)
+    h *= o
+
+def lstm_bprop(s_in, s_out, d_in, d_out, w_dense, w_diag, use_relu=False, init=False):
+  numcases, num_lstms_mult = s_in.shape
+  num_lstms = num_lstms_mult / 6
+  assert s_out.shape == s_in.shape
+  assert d_in.shape  == s_in.shape
+  assert d_out.shape == s_in.shape
+  assert w_diag.shape == (1, 3 * num_lstms)
+  assert w_dense.shape == (4 * num_lstms, num_lstms)
+
+  n = num_lstms
+  (tmp, grad_c, tanhc), _ = _get_lstm_scratch(numcases, n)
+  s = s_out.numpy_array
+  d = d_out.numpy_array
+  w = w_diag.numpy_array
+  c, i, f, a, o = [s[:, k*n:(k+1)*n] for k in xrange(1, 6)]
+  grad_h, grad_c_out, grad_i, grad_f, grad_a, grad_o = [d[:, k*n:(k+1)*n] for k in xrange(6)]
+
+  if use_relu:
+    tanhc = c
+  else:
+    np.tanh(c, out=tanhc)
+
+  # grad_o = grad_h * tanhc * o * (1 - o)
+  np.subtract(1, o, out=grad_o)
+  grad_o *= o
+  grad_o *= tanhc
+  grad_o *= grad_h
+
+  # grad_c = grad_c_out + grad_o * w_o + grad_h * o * deriv(tanhc)
+  if use_relu:
+    np.greater(tanhc, 0, out=grad_c)
+  else:
+    np.multiply(tanhc, tanhc, out=grad_c)
+    np.subtract(1, grad_c, out=grad_c)
+  grad_c *= o
+  grad_c *= grad_h
+  grad_c += grad_c_out
+  np.multiply(grad_o, w[:, 2*n:], out=tmp)
+  grad_c += tmp
+
+  # grad_a = grad_c * i * deriv(a)
+  if use_relu:
+    np.greater(a, 0, out=grad_a)
+  else:
+    np.multiply(a, a, out=grad_a)
+    np.subtract(1, grad_a, out=grad_a)
+  grad_a *= i
+  grad_a *= grad_c
+
+  # grad_i = grad_c * a * i * (1 - i)
+  np.subtract(1, i, out=grad_i)
+  grad_i *= i
+  grad_i *= a
+  grad_i *= grad_c
+
+  # grad_f = grad_c * c_old * f * (1 - f)
+  if init:
+    grad_f.fill(0)
+  else:
+    c_old = s_in.numpy_array[:, n:2*n]
+    np.subtract(1, f, out=grad_f)
+    grad_f *= f
+    grad_f *= c_old
+    grad_f *= grad_c
+
+    # grad_c_in = grad_c * f + grad_f * w_f + grad_i * w_i
+    grad_c_in = d_in.numpy_array[:, n:2*n]
+    np.multiply(grad_c, f, out=grad_c_in)
+    np.multiply(grad_f, w[:, n:2*n], out=tmp)
+    grad_c_in += tmp
+    np.multiply(grad_i, w[:, :n], out=tmp)
+    grad_c_in += tmp
+    dot(d_out.col_slice(2 * n, 6 * n), w_dense, target=d_in.col_slice(0, n), scale_targets=1.0)
+
+def lstm_outp(s_in, s_out, d_out, dw_dense, dw_diag, db, init=False):
+  numcases, num_lstms_mult = s_in.shape
+  num_lstms = num_lstms_mult / 6
+  assert s_out.shape == s_in.shape
+  assert d_out.shape == s_in.shape
+  assert dw_diag.shape == (1, 3 * num_lstms)
+  assert dw_dense.shape == (4 * num_lstms, num_lstms)
+  assert db.shape == (1, 4 * num_lstms)
+
+  n = num_lstms
+  if not init:
+    dot(d_out.col_slice(2 * n, 6 * n).T, s_in.col_slice(0, n), target=dw_dense, scale_targets=1.0)
+
+  (tmp, _, _), row = _get_lstm_scratch(numcases, n)
+  d = d_out.numpy_array
+  dw = dw_diag.numpy_array
+  row_n = row[:, :n]
+
+  # Gradients for diagonal "peephole" weights.
+  if not init:
+    c_old = s_in.numpy_array[:, n:2*n]
+    np.multiply(c_old, d[:, 2*n:3*n], out=tmp)
+    np.sum(tmp, axis=0, keepdims=True, out=row_n)
+    dw[:, :n] += row_n
+    np.multiply(c_old, d[:, 3*n:4*n], out=tmp)
+    np.sum(tmp, axis=0, keepdims=True, out=row_n)
+    dw[:, n:2*n] += row_n
+  np.multiply(s_out.numpy_array[:, n:2*n], d[:, 5*n:6*n], out=tmp)
+  np.sum(tmp, axis=0, keepdims=True, out=row_n)
+  dw[:, 2*n:] += row_n
+
+  np.sum(d[:, 2*n:], axis=0, keepdims=True, out=row)
+  db.numpy_array += row
+
+def momentum_update(w, dw, dw_history, eps, momentum, l2_decay=0., gradient_clip=0.):
+  """
+  One momentum step: dw_history = momentum * dw_history - eps * (dw +
+  l2_decay * w), clipped to [-gradient_clip, gradient_clip] if gradient_clip
+  > 0, then w += dw_history. dw is overwritten.
+  """
+  assert dw.shape == w.shape
+  assert dw_history.shape == w.shape
+  h = dw_history.numpy_array
+  if l2_decay != 0:
+    blas_axpy(w.numpy_array, dw.numpy_array, l2_decay)
+  h *= momentum
+  blas_axpy(dw.numpy_array, h, -eps)
+  if gradient_clip > 0:
+    np.clip(h, -gradient_clip, gradient_clip, out=h)
+  w.numpy_array += h
+
+# Scratch for the step of rmsprop_update and adam_update, one per shape.
+_update_scratch = {}
+
+def _get_update_scratch(shape):
+  if shape not in _update_scratch:
+    _update_scratch[shape] = np.empty(shape, dtype=np.float32, order='F')
+  return _update_scratch[shape]
+
+def rmsprop_update(w, dw, dw_sqr_history, eps, decay, l2_decay=0., gradient_clip=0., damping=1e-8):
+  """
+  One RMSProp step: with g = dw + l2_decay * w, dw_sqr_history = decay *
+  dw_sqr_history + (1 - decay) * g^2 and w -= eps * g /
+  (sqrt(dw_sqr_history) + damping), the step clipped to [-gradient_clip,
+  gradient_clip] if gradient_clip > 0. dw is overwritten.
+  """
+  assert dw.shape == w.shape
+  assert dw_sqr_history.shape == w.shape
+  g, v = dw.numpy_array, dw_sqr_history.numpy_array
+  step = _get_update_scratch(w.shape)
+  if l2_decay != 0:
+    blas_axpy(w.numpy_array, g, l2_decay)
+  np.multiply(g, g, out=step)
+  v *= decay
+  blas_axpy(step, v, 1 - decay)
+  np.sqrt(v, out=step)
+  step += damping
+  np.divide(g, step, out=step)
+  step *= eps
+  if gradient_clip > 0:
+    np.clip(step, -gradient_clip, gradient_clip, out=step)
+  w.numpy_array -= step
+
+def adam_update(w, dw, dw_history, dw_sqr_history, eps, beta1, beta2, l2_decay=0., gradient_clip=0., damping=1e-8):
+  """
+  One Adam step: with g = dw + l2_decay * w, dw_history = beta1 * dw_history
+  + (1 - beta1) * g, dw_sqr_history = beta2 * dw_sqr_history + (1 - beta2) *
+  g^2 and w -= eps * dw_history / (sqrt(dw_sqr_history) + damping), the step
+  clipped to [-gradient_clip, gradient_clip] if gradient_clip > 0. eps must
+  include the bias correction. dw is overwritten.
+  """
+  assert dw.shape == w.shape
+  assert dw_history.shape == w.shape
+  assert dw_sqr_history.shape == w.shape
+  g, m, v = dw.numpy_array, dw_history.numpy_array, dw_sqr_history.numpy_array
+  step = _get_update_scratch(w.shape)
+  if l2_decay != 0:
+    blas_axpy(w.numpy_array, g, l2_decay)
+  m *= beta1
+  blas_axpy(g, m, 1 - beta1)
+  np.multiply(g, g, out=g)
+  v *= beta2
+  blas_axpy(g, v, 1 - beta2)
+  np.sqrt(v, out=step)
+  step += damping
+  np.divide(m, step, out=step)
+  step *= eps
+  if gradient_clip > 0:
+    np.clip(step, -gradient_clip, gradient_clip, out=step)
+  w.numpy_array -= step
+
+def cuda_sync_threads():
+    pass
+
+def cuda_set_device(dev_id):
+    """
+    Selects the CUDA device with the given ID. No-op on the CPU.
+    """
+    pass
+
+def cublas_init():
+    """
+    Initialize Cublas. No-op on the CPU, BLAS needs no handle.
+    """
+    pass
+
+init = cublas_init
+
+def cublas_shutdown():
+    """
+    Shut down Cublas. No-op on the CPU.
+    """
+    pass
+
+shutdown = cublas_shutdown
@@ -2,25 +2,56 @@
 
 from util import *
 import sys
+import threading
+import multiprocessing
+import Queue
+import collections
 
-def ChooseDataHandler(data_pb):
-  if data_pb.dataset_type == config_pb2.Data.LABELLED:
+# prefetch=False returns the data handler itself, even if data_pb asks for
+# its batches to be prepared in the background.
+def ChooseDataHandler(data_pb, prefetch=True):
+  if prefetch and data_pb.num_prefetch_workers > 0:
+    return PrefetchingDataHandler(data_pb)
+  elif data_pb.dataset_type == config_pb2.Data.LABELLED:
+    return DataHandler(data_pb)
+  elif data_pb.dataset_type == config_pb2.Data.FRAME_STORE:
     return DataHandler(data_pb)
   elif data_pb.dataset_type == config_pb2.Data.UNLABELLED:
     return UnlabelledDataHandler(data_pb)
   elif data_pb.dataset_type == config_pb2.Data.BOUNCING_MNIST:
     return BouncingMNISTDataHandler(data_pb)
+  elif data_pb.dataset_type == config_pb2.Data.BOUNCING_MNIST_FIXED:
+    return BouncingMNISTFixedDataHandler(data_pb)
   elif data_pb.dataset_type == config_pb2.Data.VIDEO_PATCH:
     return VideoPatchDataHandler(data_pb)
   else:
     raise Exception('Unknown DatasetType.')
 
+# The data of worker shard out of num_shards, see Data.shard.
+def GetShard(data_pb, shard, num_shards):
+  shard_pb = config_pb2.Data()
+  shard_pb.CopyFrom(data_pb)
+  shard_pb.shard = shard
+  shard_pb.num_shards = num_shards
+  if data_pb.random_seed > 0:
+    shard_pb.random_seed = data_pb.random_seed + shard
+  return shard_pb
+
 class DataHandler(object):
   """Handling labelled datasets. 
-    Input could be anything from features of convolutional net to raw pixels."""
+    Input could be anything from features of convolutional net to raw pixels.
+    Reads an HDF5 dataset and text files, or a frame store (see FrameStore)."""
    
   def __init__(self, data_pb):
-    self.data_ = h5py.File(data_pb.data_file)[data_pb.dataset_name]
+    if data_pb.dataset_type == config_pb2.Data.FRAME_STORE:
+      frame_store = FrameStore(data_pb.data_file)
+      self.data_ = frame_store.frames_
+    elif data_pb.chunk_cache_mb > 0:
+      f = h5py.File(data_pb.data_file, 'r', rdcc_nbytes=data_pb.chunk_cache_mb * 1024 * 1024, rdcc_nslots=100003)
+      self.data_ = f[data_pb.dataset_name]
+    else:
+      f = h5py.File(data_pb.data_file, 'r')
+      self.data_ = f[data_pb.dataset_name]
     self.seq_length_ = data_pb.num_frames
     self.seq_stride_ = data_pb.stride
     self.randomize_ = data_pb.randomize
@@ -44,11 +75,13 @@ class DataHandler(object):
       self.num_colors_ = self.data_.shape[1]
 
     if data_pb.mean_file != "":
-      f = h5py.File(data_pb.mean_file)
+      f = h5py.File(data_pb.mean_file, 'r')
       self.mean_ = f['pixel_mean'].value
       self.std_ = f['pixel_std'].value
       assert self.mean_.shape[0] == self.num_colors_
       f.close()
+      self.mean_b_ = self.mean_.astype(np.float32).reshape(1, 1, -1, 1, 1)
+      self.inv_std_b_ = (1 / self.std_).astype(np.float32).reshape(1, 1, -1, 1, 1)
     else:
       self.mean_ = None
       self.std_ = None
@@ -59,49 +92,57 @@ class DataHandler(object):
     self.x_slack_ = self.image_size_x_ - self.patch_size_x_
     self.y_slack_ = self.image_size_y_ - self.patch_size_y_
     
-    video_boundaries, num_frames = self.GetBoundaries(data_pb.num_frames_file)
-    labels = self.GetLabels(data_pb.labels_file)
+    if data_pb.dataset_type == config_pb2.Data.FRAME_STORE:
+      video_boundaries, num_frames, labels = frame_store.GetVideos()
+    else:
+      video_boundaries, num_frames = self.GetBoundaries(data_pb.num_frames_file)
+      labels = self.GetLabels(data_pb.labels_file)
     assert len(labels) == len(video_boundaries)
     video_ids = self.GetVideoIds(data_pb.video_ids_file)
     if len(video_ids) == 0:
-      video_ids = range(len(labels))
+      video_ids = np.arange(len(labels))
     
-    self.num_frames_ = []
-    self.video_ind_ = {}
-    frame_indices = []
-    this_labels = []
-    for v, video_id in enumerate(video_ids):
-      this_labels.append(labels[video_id])
-      start, end = video_boundaries[video_id]
-      self.num_frames_.append(num_frames[video_id])
-      end = end - self.seq_length_ + 1
-      frame_indices.extend(range(start, end, self.seq_stride_))
-      for i in xrange(start, end, self.seq_stride_):
-        self.video_ind_[i] = v
+    video_ids = np.asarray(video_ids, dtype=np.int64)
+    self.video_starts_ = video_boundaries[video_ids, 0]
+    self.video_ends_ = video_boundaries[video_ids, 1]
+    self.num_frames_ = num_frames[video_ids]
+    self.labels_ = np.asarray(labels)[video_ids].reshape(-1, 1)
+    self.frame_indices_ = GetWindowStarts(self.video_starts_, self.video_ends_, self.seq_length_, self.seq_stride_)
+    self.shard_, self.num_shards_ = data_pb.shard, data_pb.num_shards
+    self.frame_indices_ = self.frame_indices_[self.shard_::self.num_shards_]
+    # videos sorted by start, to look up the video of a window
+    self.video_order_ = np.argsort(self.video_starts_, kind='mergesort')
+    self.sorted_video_starts_ = self.video_starts_[self.video_order_]
     
     self.num_videos_ = len(video_ids)
-    self.dataset_size_ = len(frame_indices)
+    self.dataset_size_ = len(self.frame_indices_)
     print 'Dataset size', self.dataset_size_
-    self.frame_indices_ = np.array(frame_indices) 
-    self.labels_ = np.array(this_labels).reshape(-1, 1)
 
     self.Reset()
     self.batch_data_  = np.zeros((self.batch_size_, self.seq_length_ * self.frame_size_), dtype=np.float32)
     self.batch_label_ = np.zeros((self.batch_size_, 1), dtype=np.float32)
+    num_windows = (self.batch_size_ + self.sample_times_ - 1) / self.sample_times_
+    self.windows_ = np.zeros((max(num_windows, self.batch_size_), self.seq_length_, self.data_.shape[1]),
+                             dtype=self.data_.dtype)
+    self.window_rows_ = np.arange(self.batch_size_) / self.sample_times_
+    self.y_offset_ = np.zeros(self.batch_size_, dtype=np.int64)
+    self.x_offset_ = np.zeros(self.batch_size_, dtype=np.int64)
+
+    # state of GetStreamBatch, set up on first use
+    self.stream_videos_ = None
 
   # Get the boundaries (start index and end index) of each video
   def GetBoundaries(self, filename):
-    boundaries = []
-    num_frames = []
-    start = 0
-    for line in open(filename):
-      num_f = int(line.strip())
-      num_frames.append(num_f)
-      end = start + num_f
-      boundaries.append((start, end))
-      start = end
+    num_frames = np.array([int(line.strip()) for line in open(filename)], dtype=np.int64)
+    boundaries = np.zeros((len(num_frames), 2), dtype=np.int64)
+    boundaries[:, 1] = num_frames.cumsum()
+    boundaries[1:, 0] = boundaries[:-1, 1]
     return boundaries, num_frames
 
+  # Index of the video each window starting at starts is in.
+  def GetVideo(self, starts):
+    return self.video_order_[np.searchsorted(self.sorted_video_starts_, starts, side='right') - 1]
+
   def GetLabels(self, filename):
     labels = []
     if filename != '':
@@ -133,9 +174,8 @@ class DataHandler(object):
     if self.randomize_:
       np.random.shuffle(self.frame_indices_)
 
-  # Crop the patch from image frame
-  def Crop(self, data, num_crops=1):
-    d = data.reshape((data.shape[0], self.num_colors_, self.image_size_y_, self.image_size_x_))
+  # x is drawn first, so a seed gives the same crops as before.
+  def GetCropOffset(self, num_crops=1):
     if self.x_slack_ > 0:
       x_offset = np.random.choice(self.x_slack_, size=num_crops)
     else:
@@ -144,41 +184,122 @@ class DataHandler(object):
       y_offset = np.random.choice(self.y_slack_, size=num_crops)
     else:
       y_offset = np.zeros(num_crops, dtype=np.int32)
+    return y_offset, x_offset
 
-    crops = np.zeros((num_crops, data.shape[0], self.num_colors_, self.patch_size_y_, self.patch_size_x_))
-    seq_length = data.shape[0]
-    for i in xrange(num_crops):
-      crops[i, :, :, :, :] = d[:, :,
-             y_offset[i]: y_offset[i] + self.patch_size_y_,
-             x_offset[i]: x_offset[i] + self.patch_size_x_]
+  # Crop the patch from image frame, at offset=(y_offsets, x_offsets) if given
+  def Crop(self, data, num_crops=1, offset=None):
+    if offset is None:
+      y_offset, x_offset = self.GetCropOffset(num_crops)
+    else:
+      y_offset, x_offset = offset
+    crops = np.zeros((num_crops, data.shape[0] * self.frame_size_), dtype=np.float32)
+    self.CropWindows(data.reshape((1,) + data.shape), np.zeros(num_crops, dtype=np.int64),
+                     y_offset, x_offset, crops)
+    return crops
+
+  # Crops patch i, of every frame, out of windows[rows[i]] at y_offset[i], x_offset[i],
+  # normalizes it and writes it to target[i], all in one go.
+  def CropWindows(self, windows, rows, y_offset, x_offset, target):
+    num_windows, seq_length = windows.shape[0], windows.shape[1]
+    py, px = self.patch_size_y_, self.patch_size_x_
+    d = windows.reshape((num_windows, seq_length, self.num_colors_, self.image_size_y_, self.image_size_x_))
+    # view of all the patches in d, indexed by their offsets
+    s = d.strides
+    patches = np.lib.stride_tricks.as_strided(
+      d, shape=d.shape[:3] + (self.image_size_y_ - py + 1, self.image_size_x_ - px + 1, py, px),
+      strides=s + s[3:])
+    crops = patches[rows, :, :, y_offset, x_offset]
+    out = target.reshape((len(rows), seq_length, self.num_colors_, py, px))
     if self.mean_ is not None:
-      for i in xrange(self.num_colors_):
-        crops[:, :, i, :, :] -= self.mean_[i]
-        crops[:, :, i, :, :] /= self.std_[i]
-    return crops.reshape((num_crops, -1))
+      np.subtract(crops, self.mean_b_, out=out)
+      out *= self.inv_std_b_
+    else:
+      out[...] = crops
 
   def GetBatch(self, verbose=False):
     batch_size = self.batch_size_
-    for j in xrange(batch_size):
+    num_windows = (batch_size + self.sample_times_ - 1) / self.sample_times_
+    starts = np.zeros(num_windows, dtype=np.int64)
+    for w in xrange(num_windows):
+      starts[w] = self.frame_indices_[self.frame_row_]
+      self.frame_row_ += 1
+      if self.frame_row_ == self.dataset_size_:
+        self.Reset()
+    self.ReadWindows(starts, self.windows_)
+    self.batch_label_[:, :] = self.labels_[self.GetVideo(starts)[self.window_rows_], :]
+    for w in xrange(num_windows):
       if verbose:
-        sys.stdout.write('\r%d of %d' % (j+1, batch_size))
+        sys.stdout.write('\r%d of %d' % (w+1, num_windows))
         sys.stdout.flush()
-      ind = j % self.sample_times_
-      if ind == 0:
-        start = self.frame_indices_[self.frame_row_]
-        self.frame_row_ += 1
-        if self.frame_row_ == self.dataset_size_:
-          self.Reset()
-        end = start + self.seq_length_
-        crops = self.Crop(self.data_[start:end, :], self.sample_times_)
-      self.batch_data_[j, :] = crops[ind, :].reshape(-1)
-      self.batch_label_[j, :] = self.labels_[self.video_ind_[start], :]
+      rows = slice(w * self.sample_times_, min((w + 1) * self.sample_times_, batch_size))
+      y_offset, x_offset = self.GetCropOffset(self.sample_times_)
+      num_rows = rows.stop - rows.start
+      self.y_offset_[rows], self.x_offset_[rows] = y_offset[:num_rows], x_offset[:num_rows]
+    self.CropWindows(self.windows_, self.window_rows_, self.y_offset_, self.x_offset_, self.batch_data_)
     if verbose:
       sys.stdout.write('\n')
     return self.batch_data_, self.batch_label_
 
+  # Reads the windows of seq_length frames beginning at starts into windows, in
+  # as few HDF5 reads as possible. Windows are read in order of their start,
+  # those that overlap or are less than seq_length frames apart with the same read.
+  def ReadWindows(self, starts, windows):
+    seq_length = self.seq_length_
+    order = np.argsort(starts, kind='mergesort')
+    i = 0
+    while i < len(order):
+      run_start = starts[order[i]]
+      run_end = run_start + seq_length
+      j = i + 1
+      while j < len(order) and starts[order[j]] <= run_end + seq_length:
+        run_end = max(run_end, starts[order[j]] + seq_length)
+        j += 1
+      frames = self.data_[run_start:run_end, :]
+      for w in order[i:j]:
+        windows[w] = frames[starts[w] - run_start:starts[w] - run_start + seq_length]
+      i = j
+
+  # For truncated BPTT. Each row of the batch walks through one video in windows
+  # of seq_length frames, stride frames apart, keeping the same crop, and moves
+  # on to another video when this one runs out. reset is 1 for the rows that
+  # started a new video in this batch, whose LSTM state must not be carried over.
+  def GetStreamBatch(self):
+    batch_size = self.batch_size_
+    if self.stream_videos_ is None:
+      self.stream_videos_ = [v for v in xrange(self.shard_, self.num_videos_, self.num_shards_)
+                             if self.num_frames_[v] >= self.seq_length_]
+      assert len(self.stream_videos_) > 0
+      self.stream_next_ = len(self.stream_videos_)
+      self.stream_video_ = np.zeros(batch_size, dtype=np.int32)
+      self.stream_pos_ = np.zeros(batch_size, dtype=np.int32)
+      self.stream_end_ = np.zeros(batch_size, dtype=np.int32)  # every row starts a video
+      self.stream_y_offset_ = np.zeros(batch_size, dtype=np.int64)
+      self.stream_x_offset_ = np.zeros(batch_size, dtype=np.int64)
+      self.batch_reset_ = np.zeros((batch_size, 1), dtype=np.float32)
+    for j in xrange(batch_size):
+      reset = self.stream_pos_[j] + self.seq_length_ > self.stream_end_[j]
+      if reset:
+        if self.stream_next_ == len(self.stream_videos_):
+          self.stream_next_ = 0
+          if self.randomize_:
+            np.random.shuffle(self.stream_videos_)
+        v = self.stream_videos_[self.stream_next_]
+        self.stream_next_ += 1
+        self.stream_video_[j] = v
+        self.stream_pos_[j], self.stream_end_[j] = self.video_starts_[v], self.video_ends_[v]
+        y_offset, x_offset = self.GetCropOffset()
+        self.stream_y_offset_[j], self.stream_x_offset_[j] = y_offset[0], x_offset[0]
+      self.batch_label_[j, :] = self.labels_[self.stream_video_[j], :]
+      self.batch_reset_[j, 0] = 1 if reset else 0
+    self.ReadWindows(self.stream_pos_, self.windows_)
+    self.stream_pos_ += self.seq_stride_
+    self.CropWindows(self.windows_, np.arange(batch_size), self.stream_y_offset_, self.stream_x_offset_,
+                     self.batch_data_)
+    return self.batch_data_, self.batch_label_, self.batch_reset_
+
   def GetResults(self, predictions):
     assert not self.randomize_
+    assert self.num_shards_ == 1
     assert predictions.shape[0] == self.dataset_size_
     start = 0
     pooled_correct = 0
@@ -251,6 +372,44 @@ class DataHandler(object):
         print output_file
         plt.savefig(output_file, bbox_inches='tight')
 
+# Starts of the windows of seq_length frames, stride frames apart, in each
+# video, which goes from frame video_starts[v] to video_ends[v].
+def GetWindowStarts(video_starts, video_ends, seq_length, stride):
+  num_windows = np.maximum(0, (video_ends - video_starts - seq_length + stride) / stride)
+  first_window = np.repeat(num_windows.cumsum() - num_windows, num_windows)
+  return np.repeat(video_starts, num_windows) + (np.arange(num_windows.sum()) - first_window) * stride
+
+class FrameStore(object):
+  """Frames of all videos in one memory mapped array, <prefix>.frames.npy, of
+    uint8 pixels or float16 features, with an index of where each video starts,
+    its number of frames and its label, <prefix>.index.npy. Written by
+    convert_to_frame_store.py."""
+  index_dtype = np.dtype([('start', np.int64), ('num_frames', np.int64), ('label', np.int32)])
+
+  def __init__(self, prefix):
+    self.frames_ = np.load('%s.frames.npy' % prefix, mmap_mode='r')
+    self.index_ = np.load('%s.index.npy' % prefix)
+    assert self.index_.dtype == FrameStore.index_dtype
+
+  # Returns the (start, end) of each video, its number of frames and its label.
+  def GetVideos(self):
+    start = self.index_['start']
+    num_frames = self.index_['num_frames']
+    return np.column_stack((start, start + num_frames)), num_frames, self.index_['label']
+
+  @staticmethod
+  def Create(prefix, num_frames, frame_size, dtype, labels=None):
+    num_frames = np.array(num_frames, dtype=np.int64)
+    index = np.zeros(len(num_frames), dtype=FrameStore.index_dtype)
+    index['start'][1:] = num_frames.cumsum()[:-1]
+    index['num_frames'] = num_frames
+    if labels is not None:
+      index['label'] = labels
+    np.save('%s.index.npy' % prefix, index)
+    frames = np.lib.format.open_memmap('%s.frames.npy' % prefix, mode='w+', dtype=dtype,
+                                       shape=(num_frames.sum(), frame_size))
+    return frames, index
+
 class UnlabelledDataHandler(object):
   """Handling unlabelled datasets.
      Generalizes VideoPatchDataHandler."""
@@ -278,23 +437,16 @@ class UnlabelledDataHandler(object):
 
     self.num_videos_ = len(self.filenames_)
     print 'Num videos', self.num_videos_
-    data = h5py.File(self.filenames_[0])[data_pb.dataset_name]
+    data = h5py.File(self.filenames_[0], 'r')[data_pb.dataset_name]
     self.frame_size_ = data.shape[1]
     self.dataset_name_ = data_pb.dataset_name
-    frame_indices = []
-    self.dataset_size_ = 0
-    start = 0
-    self.video_ind_ = {}
-    for v, f in enumerate(self.num_frames_):
-      end = start + f - self.seq_length_ + 1
-      frame_indices.extend(range(start, end, self.seq_stride_))
-      for i in xrange(start, end, self.seq_stride_):
-        self.video_ind_[i] = v
-      start += f
-    self.dataset_size_ = len(frame_indices)
+    self.vid_boundary_ = np.array(self.num_frames_, dtype=np.int64).cumsum()
+    self.vid_starts_ = self.vid_boundary_ - self.num_frames_
+    self.frame_indices_ = GetWindowStarts(self.vid_starts_, self.vid_boundary_, self.seq_length_, self.seq_stride_)
+    self.frame_indices_ = self.frame_indices_[data_pb.shard::data_pb.num_shards]
+    self.dataset_size_ = len(self.frame_indices_)
     print 'Dataset size', self.dataset_size_
-    self.frame_indices_ = np.array(frame_indices) 
-    self.vid_boundary_ = np.array(self.num_frames_).cumsum()
+    self.files_ = H5FileCache(data_pb.max_open_files)
     self.Reset()
     self.batch_data_  = np.zeros((self.batch_size_, self.seq_length_ * self.frame_size_), dtype=np.float32)
 
@@ -317,20 +469,76 @@ class UnlabelledDataHandler(object):
 
   def GetBatch(self, verbose=False):
     batch_size = self.batch_size_
+    starts = np.zeros(batch_size, dtype=np.int64)
     for j in xrange(batch_size):
-      start = self.frame_indices_[self.frame_row_]
-      vid_ind = self.video_ind_[start]
-      if vid_ind > 0:
-        start -= self.vid_boundary_[vid_ind - 1]
+      starts[j] = self.frame_indices_[self.frame_row_]
       self.frame_row_ += 1
       if self.frame_row_ == self.dataset_size_:
         self.Reset()
+    vid_inds = np.searchsorted(self.vid_boundary_, starts, side='right')
+    starts -= self.vid_starts_[vid_inds]
+    # each file is opened at most once per batch
+    for vid_ind, start, j in sorted(zip(vid_inds, starts, xrange(batch_size))):
       end = start + self.seq_length_
-      f = h5py.File(self.filenames_[vid_ind])
-      self.batch_data_[j, :] = f[self.dataset_name_][start:end, :].reshape(-1)
-      f.close()
+      data = self.files_.Get(self.filenames_[vid_ind], self.dataset_name_)
+      self.batch_data_[j, :] = data[start:end, :].reshape(-1)
     return self.batch_data_, None
 
+  def GetFileCacheStats(self):
+    return self.files_.GetStats()
+
+class H5FileCache(object):
+  """Keeps up to max_open_files HDF5 files open, closing the least recently used."""
+  def __init__(self, max_open_files):
+    self.max_open_files_ = max(1, max_open_files)
+    self.files_ = collections.OrderedDict()
+    self.hits_ = 0
+    self.misses_ = 0
+
+  # Returns the dataset called dataset_name in filename.
+  def Get(self, filename, dataset_name):
+    key = (filename, dataset_name)
+    if key in self.files_:
+      self.hits_ += 1
+      f, data = self.files_.pop(key)
+    else:
+      self.misses_ += 1
+      if len(self.files_) == self.max_open_files_:
+        old_f, _ = self.files_.popitem(last=False)[1]
+        old_f.close()
+      f = h5py.File(filename, 'r')
+      data = f[dataset_name]
+    self.files_[key] = (f, data)
+    return data
+
+  def GetStats(self):
+    return self.hits_, self.misses_
+
+  def Close(self):
+    for f, _ in self.files_.values():
+      f.close()
+    self.files_.clear()
+
+mnist_digits = {}
+
+# Loads the MNIST training digits once per process, into shared memory, so that
+# the data handlers of worker processes forked later use the same copy.
+def GetMNISTDigits(filename):
+  if filename not in mnist_digits:
+    try:
+      f = h5py.File(filename, 'r')
+    except:
+      print 'Please set the correct path to MNIST dataset'
+      sys.exit()
+    data = f['train']
+    digits = np.frombuffer(multiprocessing.RawArray('f', int(np.prod(data.shape))), dtype=np.float32)
+    digits = digits.reshape(data.shape)
+    data.read_direct(digits)
+    f.close()
+    digits.flags.writeable = False
+    mnist_digits[filename] = digits.reshape(-1, 28, 28)
+  return mnist_digits[filename]
+
 class BouncingMNISTDataHandler(object):
   """Data Handler that creates Bouncing MNIST dataset on the fly."""
   def __init__(self, data_pb):
@@ -343,14 +551,7 @@ class BouncingMNISTDataHandler(object):
     self.digit_size_ = 28
     self.frame_size_ = self.image_size_ ** 2
 
-    try:
-      f = h5py.File('/ais/gobi3/u/nitish/mnist/mnist.h5')
-    except:
-      print 'Please set the correct path to MNIST dataset'
-      sys.exit()
-
-    self.data_ = f['train'].value.reshape(-1, 28, 28)
-    f.close()
+    self.data_ = GetMNISTDigits('/ais/gobi3/u/nitish/mnist/mnist.h5')
     self.indices_ = np.arange(self.data_.shape[0])
     self.row_ = 0
     np.random.shuffle(self.indices_)
@@ -391,19 +592,13 @@ class BouncingMNISTDataHandler(object):
       x += v_x * self.step_length_
 
       # Bounce off edges.
-      for j in xrange(batch_size):
-        if x[j] <= 0:
-          x[j] = 0
-          v_x[j] = -v_x[j]
-        if x[j] >= 1.0:
-          x[j] = 1.0
-          v_x[j] = -v_x[j]
-        if y[j] <= 0:
-          y[j] = 0
-          v_y[j] = -v_y[j]
-        if y[j] >= 1.0:
-          y[j] = 1.0
-          v_y[j] = -v_y[j]
+      for pos, vel in ((x, v_x), (y, v_y)):
+        bounce = pos <= 0
+        pos[bounce] = 0
+        vel[bounce] *= -1
+        bounce = pos >= 1.0
+        pos[bounce] = 1.0
+        vel[bounce] *= -1
       start_y[i, :] = y
       start_x[i, :] = x
 
@@ -423,24 +618,34 @@ class BouncingMNISTDataHandler(object):
     # minibatch data
     data = np.zeros((self.batch_size_, self.seq_length_, self.image_size_, self.image_size_), dtype=np.float32)
     
-    for j in xrange(self.batch_size_):
-      for n in xrange(self.num_digits_):
-       
-        # get random digit from dataset
-        ind = self.indices_[self.row_]
-        self.row_ += 1
-        if self.row_ == self.data_.shape[0]:
-          self.row_ = 0
-          np.random.shuffle(self.indices_)
-        digit_image = self.data_[ind, :, :]
-        
-        # generate video
-        for i in xrange(self.seq_length_):
-          top    = start_y[i, j * self.num_digits_ + n]
-          left   = start_x[i, j * self.num_digits_ + n]
-          bottom = top  + self.digit_size_
-          right  = left + self.digit_size_
-          data[j, i, top:bottom, left:right] = self.Overlap(data[j, i, top:bottom, left:right], digit_image)
+    # get random digits from dataset, digit n of case j is j * num_digits + n
+    num = self.batch_size_ * self.num_digits_
+    ind = np.zeros(num, dtype=np.int64)
+    k = 0
+    while k < num:
+      take = min(num - k, self.data_.shape[0] - self.row_)
+      ind[k:k+take] = self.indices_[self.row_:self.row_+take]
+      self.row_ += take
+      k += take
+      if self.row_ == self.data_.shape[0]:
+        self.row_ = 0
+        np.random.shuffle(self.indices_)
+    digit_images = self.data_[ind, :, :]
+
+    # generate videos, for all cases and timesteps at once, through a view of
+    # every digit sized patch of the frames indexed by its top left corner
+    s = data.strides
+    patches = np.lib.stride_tricks.as_strided(
+      data, shape=data.shape[:2] + (self.image_size_ - self.digit_size_ + 1,) * 2 + (self.digit_size_,) * 2,
+      strides=s + s[2:])
+    b = np.arange(self.batch_size_).reshape(-1, 1)
+    t = np.arange(self.seq_length_).reshape(1, -1)
+    for n in xrange(self.num_digits_):
+      top  = start_y[:, n::self.num_digits_].T
+      left = start_x[:, n::self.num_digits_].T
+      digit_image = digit_images[n::self.num_digits_].reshape(self.batch_size_, 1, self.digit_size_, self.digit_size_)
+      # each frame has one digit n, so the patches written to do not overlap
+      patches[b, t, top, left] = self.Overlap(patches[b, t, top, left], digit_image)
     
     return data.reshape(self.batch_size_, -1), None
 
@@ -497,6 +702,42 @@ class BouncingMNISTDataHandler(object):
     else:
       plt.pause(0.1)
 
+class BouncingMNISTFixedDataHandler(BouncingMNISTDataHandler):
+  """Bouncing MNIST videos generated in advance, see generate_bouncing_mnist.py.
+     The .npy file is memory mapped and only the frames of each batch are read."""
+  def __init__(self, data_pb):
+    self.seq_length_ = data_pb.num_frames
+    self.batch_size_ = data_pb.batch_size
+    self.image_size_ = data_pb.image_size
+    self.frame_size_ = self.image_size_ ** 2
+
+    self.data_ = np.load(data_pb.data_file, mmap_mode='r')
+    self.data_ = self.data_.reshape(self.data_.shape[0], -1)[data_pb.shard::data_pb.num_shards]
+    assert self.data_.shape[1] == self.seq_length_ * self.frame_size_
+    self.dataset_size_ = self.data_.shape[0]
+    self.batch_data_ = np.zeros((self.batch_size_, self.seq_length_ * self.frame_size_), dtype=np.float32)
+    self.Reset()
+
+  def Reset(self):
+    self.row_ = 0
+
+  def GetBatch(self, verbose=False):
+    # pixels are in [0, 255], as uint8 from generate_bouncing_mnist.py or as
+    # floats in older files, which VIDEO_PATCH read
+    self.row_ = ReadRows(self.data_, self.row_, 1 / 255., self.batch_data_)
+    return self.batch_data_, None
+
+# Copies the rows of data from row on into target, wrapping around at the end,
+# as float32 multiplied by scale. Returns the row to continue from.
+def ReadRows(data, row, scale, target):
+  start = 0
+  while start < target.shape[0]:
+    end = min(target.shape[0], start + data.shape[0] - row)
+    np.multiply(data[row:row + end - start], scale, out=target[start:end], dtype=np.float32)
+    row = (row + end - start) % data.shape[0]
+    start = end
+  return row
+
 # video patches loaded from some file
 class VideoPatchDataHandler(object):
   def __init__(self, data_pb):
@@ -516,14 +757,16 @@ class VideoPatchDataHandler(object):
     else:
       self.frame_size_ = self.image_size_ ** 2
 
+    # memory mapped, only the frames of each batch are read and converted to float32
     try:
-      self.data_ = np.float32(np.load(self.data_file_))
-      self.data_ = self.data_ / 255.  
+      self.data_ = np.load(self.data_file_, mmap_mode='r')
     except:
       print 'Please set the correct path to the dataset'
       sys.exit()
+    self.data_ = self.data_.reshape(self.data_.shape[0], -1)[data_pb.shard::data_pb.num_shards]
 
     self.dataset_size_ = self.data_.shape[0]
+    self.batch_data_ = np.zeros((self.batch_size_, self.data_.shape[1]), dtype=np.float32)
     self.row_ = 0
 
   def GetBatchSize(self):
@@ -543,13 +786,8 @@ class VideoPatchDataHandler(object):
     pass
 
   def GetBatch(self, verbose=False):
-    minibatch = self.data_[self.row_:self.row_+self.batch_size_]    
-    self.row_ = self.row_ + self.batch_size_
-    
-    if self.row_ == self.data_.shape[0]:
-      self.row_ = 0
-    
-    return minibatch.reshape(minibatch.shape[0], -1), None
+    self.row_ = ReadRows(self.data_, self.row_, 1 / 255., self.batch_data_)
+    return self.batch_data_, None
 
   def DisplayData(self, data, rec=None, fut=None, fig=1, case_id=0, output_file=None):
     output_file1 = None
@@ -634,4 +872,169 @@ class VideoPatchDataHandler(object):
       print output_file2
       plt.savefig(output_file2, bbox_inches='tight')
     else:
-      plt.pause(0.1)
\ No newline at end of file
+      plt.pause(0.1)
+
+class PrefetchingDataHandler(object):
+  """Prepares batches of another data handler in the background.
+
+  Without prefetch_processes one thread fills the batches, whatever
+  num_prefetch_workers is: the data handler makes one batch at a time into
+  its own arrays, so more threads would only wait for each other. Worker
+  processes (prefetch_processes) each make their own data handler, on their
+  own shard of the data, see GetShard, so that every window is still read once
+  per epoch. Their random streams are seeded from one seed and their batches
+  are taken in turn, so a run is reproducible for a given number of workers,
+  though the batches differ from those of a single data handler. Reset stops
+  them and the next batch starts new ones, with the same seeds. Batches are copied into a fixed set of
+  buffers, shared memory for processes, about queue_size of them ready at a
+  time plus the one the caller is using, which is given back on the next call
+  to GetBatch. Everything else is forwarded to the data handler."""
+
+  def __init__(self, data_pb):
+    self.data_pb_ = data_pb
+    self.handler_ = ChooseDataHandler(data_pb, prefetch=False)
+    self.use_processes_ = data_pb.prefetch_processes
+    self.num_workers_ = data_pb.num_prefetch_workers if self.use_processes_ else 1
+    self.queue_size_ = max(1, data_pb.prefetch_queue_size)
+    # one queue per worker process, each with its own buffers
+    self.num_queues_ = self.num_workers_ if self.use_processes_ else 1
+    self.buffers_per_queue_ = max(2, (self.queue_size_ + self.num_queues_ - 1) / self.num_queues_ + 1)
+    num_buffers = self.num_queues_ * self.buffers_per_queue_
+
+    batch_size = self.handler_.GetBatchSize()
+    shapes = [(batch_size, self.handler_.GetSeqLength() * self.handler_.GetDims()), (batch_size, 1), (batch_size, 1)]
+    if self.use_processes_:
+      self.buffers_ = [[np.frombuffer(multiprocessing.RawArray('f', shape[0] * shape[1]), dtype=np.float32).reshape(shape)
+                        for shape in shapes] for i in xrange(num_buffers)]
+      self.has_labels_ = multiprocessing.RawArray('b', num_buffers)
+      self.free_ = [multiprocessing.Queue() for q in xrange(self.num_queues_)]
+      self.ready_ = [multiprocessing.Queue() for q in xrange(self.num_queues_)]
+      self.stop_ = multiprocessing.Event()
+      seed = data_pb.random_seed if data_pb.random_seed > 0 else np.random.randint(1 << 30)
+      self.seeds_ = np.random.RandomState(seed).randint(1 << 30, size=self.num_workers_)
+      # worker i reads every num_workers-th window of the shard of data_pb
+      num_shards = data_pb.num_shards * self.num_workers_
+      self.shard_pbs_ = [GetShard(data_pb, data_pb.shard + data_pb.num_shards * i, num_shards)
+                         for i in xrange(self.num_workers_)]
+    else:
+      self.buffers_ = [[np.zeros(shape, dtype=np.float32) for shape in shapes] for i in xrange(num_buffers)]
+      self.has_labels_ = [0] * num_buffers
+      self.free_ = [Queue.Queue()]
+      self.ready_ = [Queue.Queue()]
+      self.stop_ = threading.Event()
+    for i in xrange(num_buffers):
+      self.free_[i / self.buffers_per_queue_].put(i)
+    self.next_queue_ = 0
+    self.workers_ = []
+    self.stream_ = False
+    self.current_ = None
+    self.ResetStats()
+
+  def __getattr__(self, name):
+    return getattr(self.handler_, name)
+
+  def Start(self):
+    self.stop_.clear()
+    for i in xrange(self.num_workers_):
+      if self.use_processes_:
+        worker = multiprocessing.Process(target=RunPrefetchProcess,
+                                         args=(self.shard_pbs_[i], self.seeds_[i], self.stream_, self.buffers_,
+                                               self.has_labels_, self.free_[i], self.ready_[i], self.stop_))
+      else:
+        worker = threading.Thread(target=self.RunThread)
+      worker.daemon = True
+      worker.start()
+      self.workers_.append(worker)
+
+  def Stop(self):
+    self.stop_.set()
+    for worker in self.workers_:
+      worker.join()
+    self.workers_ = []
+    if self.current_ is not None:
+      self.free_[self.current_ / self.buffers_per_queue_].put(self.current_)
+      self.current_ = None
+    for free, ready in zip(self.free_, self.ready_):
+      while True:
+        try:
+          free.put(ready.get_nowait())
+        except Queue.Empty:
+          break
+    self.next_queue_ = 0
+
+  def RunThread(self):
+    while not self.stop_.is_set():
+      try:
+        i = self.free_[0].get(timeout=0.1)
+      except Queue.Empty:
+        continue
+      self.has_labels_[i] = FillBuffers(self.handler_, self.stream_, self.buffers_[i])
+      self.ready_[0].put(i)
+
+  def Next(self, stream):
+    if len(self.workers_) == 0:
+      self.stream_ = stream
+      self.Start()
+    assert self.stream_ == stream, 'Use either GetBatch or GetStreamBatch.'
+    if self.current_ is not None:
+      self.free_[self.current_ / self.buffers_per_queue_].put(self.current_)
+    self.queue_depth_ += sum(ready.qsize() for ready in self.ready_)
+    start = time.time()
+    self.current_ = self.ready_[self.next_queue_].get()
+    self.next_queue_ = (self.next_queue_ + 1) % self.num_queues_
+    self.wait_time_ += time.time() - start
+    self.num_batches_ += 1
+    data, label, reset = self.buffers_[self.current_]
+    return data, label if self.has_labels_[self.current_] else None, reset
+
+  def GetBatch(self, verbose=False):
+    data, label, _ = self.Next(False)
+    return data, label
+
+  # Rows of a batch continue the videos of the same rows in the previous one,
+  # so the batches must come from one data handler.
+  def GetStreamBatch(self):
+    assert not self.use_processes_ or self.num_workers_ == 1
+    return self.Next(True)
+
+  # Worker processes start over with a new data handler each.
+  def Reset(self):
+    self.Stop()
+    self.handler_.Reset()
+
+  # Average time GetBatch waited for a batch and number of batches that were
+  # ready when it was called, since the last call.
+  def GetStats(self):
+    num_batches = max(1, self.num_batches_)
+    stats = self.wait_time_ / num_batches, self.queue_depth_ / float(num_batches)
+    self.ResetStats()
+    return stats
+
+  def ResetStats(self):
+    self.num_batches_ = 0
+    self.wait_time_ = 0
+    self.queue_depth_ = 0
+
+# Copies the next batch of data_handler into buffers, returns whether it has labels.
+def FillBuffers(data_handler, stream, buffers):
+  data, label, reset = buffers
+  if stream:
+    d, l, r = data_handler.GetStreamBatch()
+    reset[:, :] = r
+  else:
+    d, l = data_handler.GetBatch()
+  data[:, :] = d
+  if l is not None:
+    label[:, :] = l
+  return l is not None
+
+def RunPrefetchProcess(data_pb, seed, stream, buffers, has_labels, free, ready, stop):
+  np.random.seed(seed)
+  data_handler = ChooseDataHandler(data_pb, prefetch=False)
+  while not stop.is_set():
+    try:
+      i = free.get(timeout=0.1)
+    except Queue.Empty:
+      continue
+    has_labels[i] = FillBuffers(data_handler, stream, buffers[i])
+    ready.put(i)
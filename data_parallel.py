@@ -0,0 +1,157 @@
+"""Data parallel training on one machine.
+
+Each of num_workers processes trains a copy of the model on its own shard of
+the training data. After BpropAndOutp the gradients are averaged through
+shared memory, so every worker makes the same update and the params stay
+identical across workers. Worker 0 prints, validates and saves, the others
+only train. Worker i uses board + i, which is ignored on the CPU backend.
+With validate_async worker 0 starts a ValidationWorker on its board.
+"""
+
+import multiprocessing
+from data_handler import *
+from validation_worker import ValidationWorker
+
+# Waits until all num_workers processes have called Wait. Raises if abort is
+# set while waiting, which happens when a worker fails.
+class Barrier(object):
+  def __init__(self, num_workers, abort):
+    self.num_workers_ = num_workers
+    self.abort_ = abort
+    self.count_ = multiprocessing.RawValue('i', 0)
+    self.generation_ = multiprocessing.RawValue('i', 0)
+    self.cond_ = multiprocessing.Condition()
+
+  def Wait(self):
+    with self.cond_:
+      generation = self.generation_.value
+      self.count_.value += 1
+      if self.count_.value == self.num_workers_:
+        self.count_.value = 0
+        self.generation_.value += 1
+        self.cond_.notify_all()
+        return
+      while generation == self.generation_.value:
+        if self.abort_.is_set():
+          raise Exception('Another worker failed.')
+        self.cond_.wait(1.0)
+
+class GradientAverager(object):
+  """Averages a (1, size) matrix, the dw_ of a ParamBuffer, across workers.
+
+  Every worker copies its gradient into its own slot of a shared array. Then
+  each one sums a chunk of the slots, in the same order in every step, into
+  a shared result that all of them copy back. Create it before starting the
+  workers and call SetRank in each of them."""
+  def __init__(self, num_workers, size):
+    self.num_workers_ = num_workers
+    self.size_ = size
+    self.abort_ = multiprocessing.Event()
+    self.barrier_ = Barrier(num_workers, self.abort_)
+    self.grads_ = multiprocessing.RawArray('f', num_workers * size)
+    self.avg_ = multiprocessing.RawArray('f', size)
+    self.rank_ = 0
+    # steps and seconds from the first to the last Average of worker 0
+    self.num_steps_ = multiprocessing.RawValue('i', 0)
+    self.start_time_ = multiprocessing.RawValue('d', 0)
+    self.end_time_ = multiprocessing.RawValue('d', 0)
+
+  def SetRank(self, rank):
+    self.rank_ = rank
+    self.grads_np_ = np.frombuffer(self.grads_, dtype=np.float32).reshape(self.num_workers_, self.size_)
+    self.avg_np_ = np.frombuffer(self.avg_, dtype=np.float32).reshape(1, self.size_)
+    chunk = (self.size_ + self.num_workers_ - 1) / self.num_workers_
+    self.start_ = min(self.size_, rank * chunk)
+    self.end_ = min(self.size_, self.start_ + chunk)
+
+  def GetRank(self):
+    return self.rank_
+
+  def GetNumWorkers(self):
+    return self.num_workers_
+
+  def Abort(self):
+    self.abort_.set()
+
+  # Copies mat of worker 0 into mat of every worker.
+  def Broadcast(self, mat):
+    assert mat.shape == (1, self.size_)
+    if self.rank_ == 0:
+      mat.copy_to_host()
+      self.avg_np_[:, :] = mat.numpy_array
+    self.barrier_.Wait()
+    if self.rank_ > 0:
+      mat.overwrite(self.avg_np_)
+    self.barrier_.Wait()
+
+  def Average(self, mat):
+    assert mat.shape == (1, self.size_)
+    mat.copy_to_host()
+    self.grads_np_[self.rank_] = mat.numpy_array
+    self.barrier_.Wait()
+    avg = self.avg_np_[0, self.start_:self.end_]
+    np.sum(self.grads_np_[:, self.start_:self.end_], axis=0, out=avg)
+    avg *= 1.0 / self.num_workers_
+    self.barrier_.Wait()
+    mat.overwrite(self.avg_np_)
+    if self.rank_ == 0:
+      if self.num_steps_.value == 0:
+        self.start_time_.value = time.time()
+      self.end_time_.value = time.time()
+      self.num_steps_.value += 1
+
+  # Number of steps and seconds between the first and the last one.
+  def GetStats(self):
+    return self.num_steps_.value, self.end_time_.value - self.start_time_.value
+
+def RunWorker(model_class, model, train_data_pb, valid_data_pb, averager, rank, board, seed):
+  try:
+    if rank > 0:
+      sys.stdout = open(os.devnull, 'w')
+    validation_worker = None
+    if rank == 0 and valid_data_pb is not None and model.validate_async:
+      validation_worker = ValidationWorker(model_class, model, valid_data_pb, board=board, seed=seed)
+    LockGPU(board=board + rank)
+    cm.CUDAMatrix.init_random(seed + rank)
+    np.random.seed(seed + rank)
+    averager.SetRank(rank)
+    net = model_class(model)
+    train_data = ChooseDataHandler(GetShard(train_data_pb, rank, averager.GetNumWorkers()))
+    valid_data = None
+    if rank == 0 and valid_data_pb is not None and validation_worker is None:
+      valid_data = ChooseDataHandler(valid_data_pb)
+    try:
+      net.Train(train_data, valid_data, averager=averager, validation_worker=validation_worker)
+    finally:
+      if validation_worker is not None:
+        validation_worker.Close()
+  except:
+    averager.Abort()
+    raise
+
+# Trains model_class(model) with model.num_workers processes. Returns the
+# GradientAverager, whose GetStats tells how fast the steps were.
+def TrainDataParallel(model_class, model, train_data_pb, valid_data_pb=None, board=0, seed=42):
+  num_workers = model.num_workers
+  # the model is only built in the workers, each on its own board
+  averager = GradientAverager(num_workers, model_class.GetNumParams(model))
+  workers = []
+  for rank in xrange(num_workers):
+    worker = multiprocessing.Process(target=RunWorker,
+                                     args=(model_class, model, train_data_pb, valid_data_pb, averager,
+                                           rank, board, seed))
+    worker.start()
+    workers.append(worker)
+  failed = False
+  while len(workers) > 0:
+    for worker in workers:
+      worker.join(0.1)
+      if not worker.is_alive():
+        failed = failed or worker.exitcode != 0
+        workers.remove(worker)
+        break
+    if failed:
+      averager.Abort()
+  if failed:
+    raise Exception('Data parallel training failed.')
+  return averager
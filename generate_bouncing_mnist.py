@@ -0,0 +1,53 @@
+"""Generates Bouncing MNIST videos for BOUNCING_MNIST_FIXED datasets.
+
+  python generate_bouncing_mnist.py <data pbtxt> <output .npy> <num videos> [num workers]
+
+The data pbtxt is that of a BOUNCING_MNIST dataset. Videos are generated in
+batches of its batch_size, each from its own seed, by a pool of worker
+processes and written as uint8 frames of shape (num videos, num_frames,
+image_size, image_size). The output only depends on the number of videos.
+"""
+
+from data_handler import *
+
+def InitWorker(data_pb, output_file):
+  global data_handler, output
+  data_handler = BouncingMNISTDataHandler(data_pb)
+  output = np.load(output_file, mmap_mode='r+')
+
+def GenerateBatch(args):
+  batch, start, end = args
+  np.random.seed(batch)
+  data_handler.row_ = 0
+  data_handler.indices_ = np.arange(data_handler.data_.shape[0])
+  np.random.shuffle(data_handler.indices_)
+  data, _ = data_handler.GetBatch()
+  frames = np.round(data[:end-start] * 255).reshape(output[start:end].shape)
+  output[start:end] = frames.astype(np.uint8)
+  output.flush()
+  return end - start
+
+def main():
+  data_pb = ReadDataProto(sys.argv[1])
+  output_file = sys.argv[2]
+  num_videos = int(sys.argv[3])
+  num_workers = int(sys.argv[4]) if len(sys.argv) > 4 else multiprocessing.cpu_count()
+  assert data_pb.dataset_type == config_pb2.Data.BOUNCING_MNIST
+  shape = (num_videos, data_pb.num_frames, data_pb.image_size, data_pb.image_size)
+  np.lib.format.open_memmap(output_file, mode='w+', dtype=np.uint8, shape=shape).flush()
+
+  batch_size = data_pb.batch_size
+  batches = [(b, start, min(start + batch_size, num_videos))
+             for b, start in enumerate(xrange(0, num_videos, batch_size))]
+  pool = multiprocessing.Pool(num_workers, initializer=InitWorker, initargs=(data_pb, output_file))
+  done = 0
+  for n in pool.imap_unordered(GenerateBatch, batches):
+    done += n
+    sys.stdout.write('\r%d of %d' % (done, num_videos))
+    sys.stdout.flush()
+  pool.close()
+  pool.join()
+  sys.stdout.write('\n')
+
+if __name__ == '__main__':
+  main()
@@ -12,6 +12,7 @@ class LogReg(object):
       ('%s:w' % self.name_, self.w_),
       ('%s:b' % self.name_, self.b_),
     ]
+    self.param_buffer_ = ParamBuffer([self.w_, self.b_])
     self.dropprob_ = logreg_config.dropprob
 
   def __str__(self):
@@ -53,8 +54,7 @@ class LogReg(object):
     self.o_deriv_.sum(axis=0, target=self.b_.GetdW())
 
   def Update(self):
-    self.w_.Update()
-    self.b_.Update()
+    self.param_buffer_.Update()
 
   def GetCorrect(self, t):
     self.o_.get_softmax_correct_row_major(t, self.c_)
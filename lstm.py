@@ -14,7 +14,12 @@ class LSTM(object):
     self.use_relu_    = lstm_config.use_relu
     self.input_dropprob_  = lstm_config.input_dropprob
     self.output_dropprob_ = lstm_config.output_dropprob
+    self.store_only_hc_ = lstm_config.store_only_hc
     self.t_ = 0
+    self.train_ = False
+    self.batch_config_ = None
+    self.state_arena_ = None
+    self.deriv_arena_ = None
 
     print num_lstms
     # diag are peephole connections from cell state to diffent gates
@@ -39,6 +44,17 @@ class LSTM(object):
       self.b_output_ = Param((1, self.output_dims_), lstm_config.b_output)
       self.param_list_.append(('%s:b_output' % self.name_, self.b_output_))
 
+  # Number of weights of an LSTM with this config, without allocating them.
+  @staticmethod
+  def GetNumParams(lstm_config):
+    n = lstm_config.num_hid
+    num_params = 4 * n * n + 3 * n + 4 * n
+    if lstm_config.has_input:
+      num_params += 4 * n * lstm_config.input_dims
+    if lstm_config.has_output:
+      num_params += lstm_config.output_dims * n + lstm_config.output_dims
+    return num_params
+
   def HasInputs(self):
     return self.has_input_
 
@@ -48,24 +64,107 @@ class LSTM(object):
   def GetParams(self):
     return self.param_list_
 
-  def SetBatchSize(self, batch_size, seq_length):
+  # With train=False only what Fprop needs for inference is allocated: a ring
+  # of two states instead of one per timestep, and no derivs or dropout masks.
+  # With checkpoint_every=k > 0 only k states are kept, plus h and c of every
+  # k-th timestep to recompute the others from, see LSTMStack.BpropAndOutp.
+  def SetBatchSize(self, batch_size, seq_length, project_inputs=False, train=True, checkpoint_every=0):
     assert batch_size > 0
     assert seq_length > 0
+    assert checkpoint_every == 0 or (train and checkpoint_every < seq_length)
+    assert not (project_inputs and checkpoint_every > 0)
+    project_inputs = project_inputs and train
+    # Show and RunAndShow call this again with the same sizes, nothing to do then.
+    batch_config = (batch_size, seq_length, project_inputs, train, checkpoint_every)
+    if self.batch_config_ == batch_config:
+      self.Reset()
+      return
+    self.batch_config_ = batch_config
     self.batch_size_  = batch_size
     self.seq_length_  = seq_length
-    self.state_ = [cm.empty((batch_size, 6 * self.num_lstms_)) for i in xrange(seq_length)]
-    self.deriv_ = [cm.empty((batch_size, 6 * self.num_lstms_)) for i in xrange(seq_length)]
+    self.inference_   = not train
+    self.checkpoint_every_ = checkpoint_every
+    # number of timesteps whose states and stacked inputs and derivs are held at once
+    self.segment_length_ = checkpoint_every if checkpoint_every > 0 else seq_length
+    store_only_hc = self.store_only_hc_ and train and checkpoint_every == 0
+    self.t_ = 0
 
-    # dropout mask
-    if self.has_output_ and self.output_dropprob_ > 0:
-      self.output_drop_mask_ = [cm.empty((batch_size, self.num_lstms_)) for i in xrange(seq_length)]
-      self.output_intermediate_state_ = [cm.empty((batch_size, self.num_lstms_)) for i in xrange(seq_length)]
-      self.output_intermediate_deriv_ = [cm.empty((batch_size, self.num_lstms_)) for i in xrange(seq_length)]
+    # States and derivs of all timesteps live in one arena per layer, state_[t]
+    # and deriv_[t] are views into it. Kept if it is big enough for this batch.
+    num_lstms = self.num_lstms_
+    state_size = 6 * num_lstms
+    num_slots = max(self.segment_length_, 2) if train and not store_only_hc else 2
+    num_slots = min(num_slots, seq_length)
+    self.state_arena_ = self.GetArena(self.state_arena_, batch_size, num_slots * state_size)
+    slots = [self.state_arena_.col_slice(t * state_size, (t+1) * state_size) for t in xrange(num_slots)]
+    self.state_ = [slots[t % num_slots] for t in xrange(seq_length)]
+    if train:
+      # Bprop at t only touches the derivs at t and t-1.
+      num_deriv_slots = min(2, seq_length) if checkpoint_every > 0 or store_only_hc else seq_length
+      self.deriv_arena_ = self.GetArena(self.deriv_arena_, batch_size, num_deriv_slots * state_size)
+      deriv_slots = [self.deriv_arena_.col_slice(t * state_size, (t+1) * state_size) for t in xrange(num_deriv_slots)]
+      self.deriv_ = [deriv_slots[t % num_deriv_slots] for t in xrange(seq_length)]
+    else:
+      self.deriv_arena_ = None
+      self.deriv_ = None
 
-    if self.has_input_ and self.input_dropprob_ > 0:
+    # h and c of every timestep when the full states are not kept
+    if store_only_hc:
+      self.hc_arena_ = cm.empty((batch_size, seq_length * 2 * num_lstms))
+      self.hc_ = [self.hc_arena_.col_slice(t * 2 * num_lstms, (t+1) * 2 * num_lstms) for t in xrange(seq_length)]
+    else:
+      self.hc_arena_ = None
+      self.hc_ = None
+
+    if checkpoint_every > 0:
+      num_checkpoints = (seq_length - 1) / checkpoint_every
+      self.checkpoint_arena_ = cm.empty((batch_size, num_checkpoints * 2 * num_lstms))
+      self.checkpoints_ = [self.checkpoint_arena_.col_slice(i * 2 * num_lstms, (i+1) * 2 * num_lstms)
+                           for i in xrange(num_checkpoints)]
+      self.restart_state_ = cm.empty((batch_size, state_size))
+    else:
+      self.checkpoint_arena_ = None
+      self.checkpoints_ = None
+      self.restart_state_ = None
+
+    # Inputs, hidden states and derivs of a segment of timesteps stacked along
+    # rows, so that the input and output weight gradients take one GEMM each.
+    self.input_projected_ = [False] * seq_length
+    self.input_seq_ = None
+    self.input_proj_ = None
+    self.gates_deriv_seq_ = None
+    self.hidden_seq_ = None
+    self.output_deriv_seq_ = None
+    num_rows = batch_size * self.segment_length_
+    if train and self.has_input_:
+      self.input_seq_ = cm.empty((num_rows, self.input_dims_))
+      self.input_seq_.assign(0)
+      self.gates_deriv_seq_ = cm.empty((num_rows, 4 * num_lstms))
+      if project_inputs:
+        self.input_proj_ = cm.empty((num_rows, 4 * num_lstms))
+    if train and self.has_output_:
+      self.hidden_seq_ = cm.empty((num_rows, num_lstms))
+      self.output_deriv_seq_ = cm.empty((num_rows, self.output_dims_))
+
+    # dropout mask, the intermediates are recomputed along with the states
+    if train and self.has_output_ and self.output_dropprob_ > 0:
+      self.output_drop_mask_ = [cm.empty((batch_size, num_lstms)) for i in xrange(seq_length)]
+      intermediate_state = [cm.empty((batch_size, num_lstms)) for i in xrange(num_slots)]
+      intermediate_deriv = [cm.empty((batch_size, num_lstms)) for i in xrange(num_slots)]
+      self.output_intermediate_state_ = [intermediate_state[t % num_slots] for t in xrange(seq_length)]
+      self.output_intermediate_deriv_ = [intermediate_deriv[t % num_slots] for t in xrange(seq_length)]
+
+    if train and self.has_input_ and self.input_dropprob_ > 0:
       self.input_drop_mask_ = [cm.empty((batch_size, self.input_dims_)) for i in xrange(seq_length)]
-      self.input_intermediate_state_ = [cm.empty((batch_size, self.input_dims_)) for i in xrange(seq_length)]
-      self.input_intermediate_deriv_ = [cm.empty((batch_size, self.input_dims_)) for i in xrange(seq_length)]
+      intermediate_state = [cm.empty((batch_size, self.input_dims_)) for i in xrange(num_slots)]
+      intermediate_deriv = [cm.empty((batch_size, self.input_dims_)) for i in xrange(num_slots)]
+      self.input_intermediate_state_ = [intermediate_state[t % num_slots] for t in xrange(seq_length)]
+      self.input_intermediate_deriv_ = [intermediate_deriv[t % num_slots] for t in xrange(seq_length)]
+
+  def GetArena(self, arena, batch_size, width):
+    if arena is None or arena.shape[0] != batch_size or arena.shape[1] < width:
+      arena = cm.empty((batch_size, width))
+    return arena
 
   def Load(self, f):
     for name, p in self.param_list_:
@@ -75,10 +174,75 @@ class LSTM(object):
     for name, p in self.param_list_:
       p.Save(f, name)
 
+  # Project the inputs of all timesteps onto the gates with a single GEMM.
+  # input_frames has one entry per timestep, None where there is no input.
+  # Must be called after Reset and before the first Fprop.
+  def ProjectInputs(self, input_frames, train=False):
+    assert self.input_proj_ is not None
+    assert len(input_frames) == self.seq_length_
+    batch_size = self.batch_size_
+    for t, input_frame in enumerate(input_frames):
+      if input_frame is None:
+        continue
+      if self.input_dropprob_ > 0 and train:
+        mask = self.input_drop_mask_[t]
+        intermediate_state = self.input_intermediate_state_[t]
+        mask.assign(1 - self.input_dropprob_)
+        mask.sample_bernoulli()
+        mask.mult(1.0 / (1 - self.input_dropprob_))
+        input_frame.mult(mask, target=intermediate_state)
+        input_frame = intermediate_state
+      self.input_seq_.set_row_slice(t * batch_size, (t+1) * batch_size, input_frame)
+      self.input_projected_[t] = True
+    cm.dot(self.input_seq_, self.w_input_.GetW().T, target=self.input_proj_)
+
   def Fprop(self, input_frame=None, init_state=None, output_frame=None, train=False, copy_init_state=True):
     t = self.t_
     assert t >= 0
     assert t < self.seq_length_
+    assert not (train and self.inference_)
+    num_lstms = self.num_lstms_
+
+    # The deriv of the last state is only accumulated into, starting with
+    # the layer above. Everything else is overwritten before it is read.
+    if t == self.seq_length_ - 1 and not self.inference_:
+      self.deriv_[t].col_slice(0, 2 * num_lstms).assign(0)
+
+    self.FpropStep(t, input_frame=input_frame, init_state=init_state, output_frame=output_frame,
+                   train=train, copy_init_state=copy_init_state)
+    self.train_ = train
+
+    if self.hc_ is not None:
+      self.hc_[t].assign(self.state_[t].col_slice(0, 2 * num_lstms))
+
+    k = self.checkpoint_every_
+    if k > 0 and t % k == k - 1 and t / k < len(self.checkpoints_):
+      self.checkpoints_[t / k].assign(self.state_[t].col_slice(0, 2 * num_lstms))
+    
+    self.t_ += 1
+
+  # Recomputes the state at t from the one at t-1, reusing the dropout masks
+  # sampled by Fprop. The first timestep of a segment starts from its checkpoint.
+  def Recompute(self, t, input_frame=None, init_state=None, train=False, copy_init_state=True):
+    k = self.checkpoint_every_
+    assert k > 0
+    if t > 0 and t % k == 0:
+      self.LoadCheckpoint(t)
+    self.FpropStep(t, input_frame=input_frame, init_state=init_state,
+                   train=train, copy_init_state=copy_init_state, recompute=True)
+
+  def LoadCheckpoint(self, t):
+    self.restart_state_.col_slice(0, 2 * self.num_lstms_).assign(self.checkpoints_[t / self.checkpoint_every_ - 1])
+
+  # State at t-1. In the backward pass a segment starts from its checkpoint.
+  def GetPrevState(self, t, backward=False):
+    k = self.checkpoint_every_
+    if backward and k > 0 and t % k == 0:
+      return self.restart_state_
+    return self.state_[t-1]
+
+  def FpropStep(self, t, input_frame=None, init_state=None, output_frame=None, train=False,
+                copy_init_state=True, recompute=False):
     num_lstms = self.num_lstms_
     output_slice = self.state_[t]
     gates = output_slice.col_slice(2 * num_lstms, 6 * num_lstms)
@@ -97,21 +261,26 @@ class LSTM(object):
           input_slice = init_state
         init = False
     else:
-      input_slice = self.state_[t-1]
+      input_slice = self.GetPrevState(t, backward=recompute)
       init = False
     
     # input to LSTM
     if self.has_input_ and input_frame is not None and not lstm_state_computed:
-      if self.input_dropprob_ > 0 and train:
+      if self.input_projected_[t]:
+        self.input_proj_.get_row_slice(t * self.batch_size_, (t+1) * self.batch_size_, target=gates)
+      elif self.input_dropprob_ > 0 and train:
         mask = self.input_drop_mask_[t]
         intermediate_state = self.input_intermediate_state_[t]
-        mask.assign(1 - self.input_dropprob_)
-        mask.sample_bernoulli()
-        mask.mult(1.0 / (1 - self.input_dropprob_))
+        if not recompute:
+          mask.assign(1 - self.input_dropprob_)
+          mask.sample_bernoulli()
+          mask.mult(1.0 / (1 - self.input_dropprob_))
         input_frame.mult(mask, target=intermediate_state)
         cm.dot(intermediate_state, self.w_input_.GetW().T, target=gates)
       else:
         cm.dot(input_frame, self.w_input_.GetW().T, target=gates)
+    elif not lstm_state_computed:
+      gates.assign(0)
     
     # internal LSTM state computations
     if not lstm_state_computed:
@@ -119,65 +288,83 @@ class LSTM(object):
                     self.w_dense_.GetW(), self.w_diag_.GetW(), self.b_.GetW(),
                     use_relu=self.use_relu_, init=init)
 
-    # LSTM to output
+    # LSTM to output, when recomputing only what Bprop reads is redone
     if self.has_output_:
-      assert output_frame is not None
+      assert recompute or output_frame is not None
       state = output_slice.col_slice(0, num_lstms)
       
       if self.output_dropprob_ > 0 and train:
         mask = self.output_drop_mask_[t]
         intermediate_state = self.output_intermediate_state_[t]
-        mask.assign(1 - self.output_dropprob_)
-        mask.sample_bernoulli()
-        mask.mult(1.0 / (1 - self.output_dropprob_))
+        if not recompute:
+          mask.assign(1 - self.output_dropprob_)
+          mask.sample_bernoulli()
+          mask.mult(1.0 / (1 - self.output_dropprob_))
         state.mult(mask, target=intermediate_state)
-        cm.dot(intermediate_state, self.w_output_.GetW().T, target=output_frame)
-      else:
+        state = intermediate_state
+      if not recompute:
         cm.dot(state, self.w_output_.GetW().T, target=output_frame)
-      output_frame.add_row_vec(self.b_output_.GetW())
-    
-    self.t_ += 1
+        output_frame.add_row_vec(self.b_output_.GetW())
 
   # Bprop for getting gradients
   # Outp for updating weights
   def BpropAndOutp(self, input_frame=None, input_deriv=None,
                    init_state=None, init_deriv=None, output_deriv=None, copy_init_state=True):
+    assert not self.inference_
     self.t_ -= 1
 
     t = self.t_
     assert t >= 0
     assert t < self.seq_length_
     num_lstms = self.num_lstms_
+
+    # only h and c were kept, rebuild the rest of the state at t
+    if self.hc_ is not None:
+      if t > 0:
+        self.state_[t-1].col_slice(0, 2 * num_lstms).assign(self.hc_[t-1])
+      self.FpropStep(t, input_frame=input_frame, init_state=init_state, train=self.train_,
+                     copy_init_state=copy_init_state, recompute=True)
+
     output_slice_h = self.state_[t]
     output_slice_d = self.deriv_[t]
 
     # set gradients to zero
     if t == self.seq_length_ - 1:
-      if self.has_output_:
-        self.w_output_.GetdW().assign(0)
-        self.b_output_.GetdW().assign(0)
-      if self.has_input_:
-        self.w_input_.GetdW().assign(0)
       self.w_dense_.GetdW().assign(0)
       self.w_diag_.GetdW().assign(0)
       self.b_.GetdW().assign(0)
+      # the last segment is not recomputed, but still starts from its checkpoint
+      k = self.checkpoint_every_
+      if k > 0:
+        self.LoadCheckpoint(t - t % k)
+
+    # first timestep of a segment in the backward pass
+    seg = self.segment_length_
+    if t == self.seq_length_ - 1 or t % seg == seg - 1:
+      # rows of timesteps without input must not contribute to w_input's gradient
+      if self.has_input_:
+        self.gates_deriv_seq_.assign(0)
+      # nor the rows a shorter last segment leaves over from the previous sweep
+      if self.has_output_ and t % seg != seg - 1:
+        self.output_deriv_seq_.assign(0)
     
+    row_start, row_end = (t % seg) * self.batch_size_, (t % seg + 1) * self.batch_size_
     if self.has_output_:
       assert output_deriv is not None  # If this lstm's output was used, it must get a deriv back.
       deriv = output_slice_d.col_slice(0, num_lstms)
       state = output_slice_h.col_slice(0, num_lstms)
+      self.output_deriv_seq_.set_row_slice(row_start, row_end, output_deriv)
       if self.output_dropprob_ > 0:
         mask = self.output_drop_mask_[t]
         intermediate_state = self.output_intermediate_state_[t]
         intermediate_deriv = self.output_intermediate_deriv_[t]
-        cm.dot(output_deriv.T, intermediate_state, target=self.w_output_.GetdW(), scale_targets=1.0)
+        self.hidden_seq_.set_row_slice(row_start, row_end, intermediate_state)
         cm.dot(output_deriv, self.w_output_.GetW(), target=intermediate_deriv, scale_targets=0.0)
         intermediate_deriv.mult(mask)
         deriv.add(intermediate_deriv)
       else:
-        cm.dot(output_deriv.T, state, target=self.w_output_.GetdW(), scale_targets=1.0)
+        self.hidden_seq_.set_row_slice(row_start, row_end, state)
         cm.dot(output_deriv, self.w_output_.GetW(), target=deriv, scale_targets=1.0)
-      self.b_output_.GetdW().add_sums(output_deriv, axis=0)
 
     deriv_computed = False
     if t == 0:
@@ -194,8 +381,9 @@ class LSTM(object):
           input_slice_d  = init_deriv
         init = False
     else:
-      input_slice_h  = self.state_[t-1]
+      input_slice_h  = self.GetPrevState(t, backward=True)
       input_slice_d  = self.deriv_[t-1]
+      input_slice_d.col_slice(0, num_lstms).assign(0)  # lstm_bprop accumulates into it
       init = False
 
     if not deriv_computed:
@@ -210,9 +398,11 @@ class LSTM(object):
     gates_deriv = output_slice_d.col_slice(2 * num_lstms, 6 * num_lstms)
 
     if self.has_input_ and input_frame is not None and not deriv_computed:
+      self.gates_deriv_seq_.set_row_slice(row_start, row_end, gates_deriv)
       if self.input_dropprob_ > 0:
         intermediate_state = self.input_intermediate_state_[t]
-        cm.dot(gates_deriv.T, intermediate_state, target=self.w_input_.GetdW(), scale_targets=1.0)
+        if not self.input_projected_[t]:
+          self.input_seq_.set_row_slice(row_start, row_end, intermediate_state)
         if input_deriv is not None:  # If the caller has asked for the deriv wrt input to be computed, do it.
           mask = self.input_drop_mask_[t]
           intermediate_deriv = self.input_intermediate_deriv_[t]
@@ -220,15 +410,33 @@ class LSTM(object):
           intermediate_deriv.mult(mask)
           input_deriv.add(intermediate_deriv)
       else:
-        cm.dot(gates_deriv.T, input_frame, target=self.w_input_.GetdW(), scale_targets=1.0)
+        if not self.input_projected_[t]:
+          self.input_seq_.set_row_slice(row_start, row_end, input_frame)
         if input_deriv is not None:  # If the caller has asked for the deriv wrt input to be computed, do it.
           cm.dot(gates_deriv, self.w_input_.GetW(), target=input_deriv, scale_targets=1.0)
 
+    # end of a segment (the whole sequence unless checkpointing),
+    # add its part of the input and output weight gradients
+    if t % seg == 0:
+      scale = 0.0 if t + seg >= self.seq_length_ else 1.0  # first segment of the sweep
+      if self.has_input_:
+        cm.dot(self.gates_deriv_seq_.T, self.input_seq_, target=self.w_input_.GetdW(), scale_targets=scale)
+      if self.has_output_:
+        cm.dot(self.output_deriv_seq_.T, self.hidden_seq_, target=self.w_output_.GetdW(), scale_targets=scale)
+        if scale == 0:
+          self.b_output_.GetdW().assign(0)
+        self.b_output_.GetdW().add_sums(self.output_deriv_seq_, axis=0)
+
   def GetCurrentState(self):
     return self.state_[self.t_ - 1]
 
   def GetCurrentHiddenState(self):
-    return self.state_[self.t_ - 1].col_slice(0, self.num_lstms_)
+    return self.GetHiddenState(self.t_ - 1)
+
+  def GetHiddenState(self, t):
+    if self.hc_ is not None:
+      return self.hc_[t].col_slice(0, self.num_lstms_)
+    return self.state_[t].col_slice(0, self.num_lstms_)
   
   def GetCurrentDeriv(self):
     return self.deriv_[self.t_ - 1]
@@ -236,16 +444,6 @@ class LSTM(object):
   def GetCurrentHiddenDeriv(self):
     return self.deriv_[self.t_ - 1].col_slice(0, self.num_lstms_)
 
-  def Update(self):
-    self.w_dense_.Update()
-    self.w_diag_.Update()
-    self.b_.Update()
-    if self.has_input_:
-      self.w_input_.Update()
-    if self.has_output_:
-      self.w_output_.Update()
-      self.b_output_.Update()
-
   def Display(self, fig=1):
     plt.figure(2*fig)
     plt.clf()
@@ -293,9 +491,7 @@ class LSTM(object):
 
   def Reset(self):
     self.t_ = 0
-    for t in xrange(self.seq_length_):
-      self.state_[t].assign(0)
-      self.deriv_[t].assign(0)
+    self.input_projected_ = [False] * self.seq_length_
 
   def GetInputDims(self):
     return self.input_dims_
@@ -303,11 +499,17 @@ class LSTM(object):
   def GetOutputDims(self):
     return self.output_dims_
 
+  def GetNumLSTMs(self):
+    return self.num_lstms_
+
 # LSTMStack is a stack of different lstm layers
 class LSTMStack(object):
-  def __init__(self):
+  def __init__(self, checkpoint_every=0):
     self.models_ = []
     self.num_models_ = 0
+    self.checkpoint_every_ = checkpoint_every
+    self.carry_state_ = False
+    self.carry_ = False
 
   def Add(self, model):
     self.models_.append(model)
@@ -315,8 +517,19 @@ class LSTMStack(object):
 
   def Fprop(self, input_frame=None, init_state=[], output_frame=None, train=False, copy_init_state=True):
     num_models = self.num_models_
+    if self.carry_ and len(init_state) == 0:
+      init_state = self.carry_states_
+      copy_init_state = False
     num_init_state = len(init_state)
     assert num_init_state == 0 or num_init_state == num_models
+    if self.recompute_every_ > 0 and num_models > 0:
+      # remember what is needed to recompute the states in BpropAndOutp
+      t = self.models_[0].t_
+      self.input_frames_[t] = input_frame
+      if t == 0:
+        self.init_state_ = init_state
+        self.copy_init_state_ = copy_init_state
+        self.train_ = train
     for m, model in enumerate(self.models_):
       this_input_frame  = input_frame if m == 0 else self.models_[m-1].GetCurrentHiddenState()
       this_init_state   = init_state[m] if num_init_state > 0 else None
@@ -325,12 +538,32 @@ class LSTMStack(object):
                   init_state=this_init_state,
                   output_frame=this_output_frame,
                   train=train, copy_init_state=copy_init_state)
+    # only a chunk started with CarryState hands its state on, not validation
+    if self.carry_ and num_models > 0 and self.models_[0].t_ == self.seq_length_:
+      for m, model in enumerate(self.models_):
+        self.next_carry_states_[m].assign(model.GetCurrentState())
 
   def BpropAndOutp(self, input_frame=None, input_deriv=None,
                    init_state=[], init_deriv=[], output_deriv=None, copy_init_state=True):
     num_models = self.num_models_
+    if self.carry_ and len(init_state) == 0:
+      # the deriv wrt the carried state is not propagated into the previous chunk
+      init_state = self.carry_states_
+      init_deriv = self.carry_derivs_
+      copy_init_state = False
+      if num_models > 0 and self.models_[0].t_ == 1:
+        for d in init_deriv:
+          d.assign(0)
     num_init_state = len(init_state)
     assert num_init_state == 0 or num_init_state == num_models
+    k = self.recompute_every_
+    if k > 0 and num_models > 0:
+      # Only the states of the last segment are still there from Fprop,
+      # every other segment is recomputed before it is backpropagated.
+      t = self.models_[0].t_ - 1
+      last_segment_start = (self.seq_length_ - 1) / k * k
+      if t % k == k - 1 and t < last_segment_start:
+        self.RecomputeSegment(t - k + 1, t + 1)
     for m in xrange(num_models-1, -1, -1):
       model = self.models_[m]
       this_input_frame  = input_frame if m == 0 else self.models_[m-1].GetCurrentHiddenState()
@@ -345,20 +578,62 @@ class LSTMStack(object):
                          output_deriv=this_output_deriv,
                          copy_init_state=copy_init_state)
 
+  def RecomputeSegment(self, start, end):
+    num_init_state = len(self.init_state_)
+    for t in xrange(start, end):
+      for m, model in enumerate(self.models_):
+        this_input_frame = self.input_frames_[t] if m == 0 else self.models_[m-1].GetHiddenState(t)
+        this_init_state  = self.init_state_[m] if t == 0 and num_init_state > 0 else None
+        model.Recompute(t, input_frame=this_input_frame, init_state=this_init_state,
+                        train=self.train_, copy_init_state=self.copy_init_state_)
+
+  def ProjectInputs(self, input_frames, train=False):
+    if self.num_models_ > 0:
+      self.models_[0].ProjectInputs(input_frames, train=train)
+
   def Reset(self):
+    self.carry_ = False
     for model in self.models_:
       model.Reset()
 
-  def Update(self):
-    for model in self.models_:
-      model.Update()
+  # For truncated BPTT, call after Reset. The next Fprop starts from the last
+  # state of the previous one instead of zeros, except in the rows where
+  # reset is 1. Gradients do not flow back across the boundary.
+  def CarryState(self, reset):
+    assert self.carry_state_
+    self.carry_states_, self.next_carry_states_ = self.next_carry_states_, self.carry_states_
+    reset.mult(-1, target=self.keep_)
+    self.keep_.add(1)
+    for state in self.carry_states_:
+      state.mult_by_col(self.keep_)
+    self.carry_ = True
 
   def GetNumModels(self):
     return self.num_models_
   
-  def SetBatchSize(self, batch_size, seq_length):
-    for model in self.models_:
-      model.SetBatchSize(batch_size, seq_length)
+  # project_inputs allocates the buffers needed by ProjectInputs.
+  # Only the first layer sees external inputs, so only it gets them.
+  # carry_state allocates the states carried across calls by CarryState.
+  def SetBatchSize(self, batch_size, seq_length, project_inputs=False, train=True, carry_state=False):
+    self.seq_length_ = seq_length
+    self.carry_state_ = carry_state
+    self.carry_ = False
+    if carry_state:
+      self.carry_states_ = [cm.empty((batch_size, 6 * m.GetNumLSTMs())) for m in self.models_]
+      self.next_carry_states_ = [cm.empty((batch_size, 6 * m.GetNumLSTMs())) for m in self.models_]
+      self.carry_derivs_ = [cm.empty((batch_size, 6 * m.GetNumLSTMs())) for m in self.models_]
+      for state in self.carry_states_ + self.next_carry_states_:
+        state.assign(0)
+      self.keep_ = cm.empty((batch_size, 1))
+    # checkpointing only pays off when training on more than one segment
+    self.recompute_every_ = self.checkpoint_every_ if train and self.checkpoint_every_ < seq_length else 0
+    self.input_frames_ = [None] * seq_length
+    self.init_state_ = []
+    self.copy_init_state_ = True
+    self.train_ = False
+    for m, model in enumerate(self.models_):
+      model.SetBatchSize(batch_size, seq_length, project_inputs=project_inputs and m == 0, train=train,
+                         checkpoint_every=self.recompute_every_)
 
   def Save(self, f):
     for model in self.models_:
@@ -1,15 +1,19 @@
 from data_handler import *
+from data_parallel import TrainDataParallel
+from validation_worker import ValidationWorker
 import lstm
 import datetime
 
 class LSTMClassifier(object):
   def __init__(self, model):
     self.model_ = model
-    self.lstm_stack_ = lstm.LSTMStack()
+    self.lstm_stack_ = lstm.LSTMStack(checkpoint_every=model.checkpoint_states_every)
     for l in model.lstm:
       self.lstm_stack_.Add(lstm.LSTM(l))
     self.squash_relu_ = model.squash_relu
     self.squash_relu_lambda_ = model.squash_relu_lambda
+    self.param_buffer_ = ParamBuffer([param for _, param in self.lstm_stack_.GetParams()], optimizer=model.optimizer)
+    self.checkpoint_writer_ = None
     
     if len(model.timestamp) > 0:
       old_st = model.timestamp[-1]
@@ -18,6 +22,11 @@ class LSTMClassifier(object):
       self.lstm_stack_.Load(f)
       f.close()
 
+  # Number of weights of LSTMClassifier(model), without allocating them.
+  @staticmethod
+  def GetNumParams(model):
+    return sum(lstm.LSTM.GetNumParams(l) for l in model.lstm)
+
   # used to check if gradient fucntion was implemented correctly
   def GradCheck(self):
     eps = 0.01
@@ -67,6 +76,11 @@ class LSTMClassifier(object):
       self.v_.apply_relu_squash(lambdaa=self.squash_relu_lambda_)
     num_models = self.lstm_stack_.GetNumModels()
     self.lstm_stack_.Reset()
+    if train and self.stream_:
+      self.lstm_stack_.CarryState(self.reset_)
+    if self.project_inputs_:
+      self.lstm_stack_.ProjectInputs([self.v_.col_slice(t * self.num_dims_, (t+1) * self.num_dims_)
+                                      for t in xrange(self.seq_length_)], train=train)
     for t in xrange(self.seq_length_):
       # slice input and output at timestep t and get probabilities
       i = self.v_.col_slice(t * self.num_dims_, (t+1) * self.num_dims_)
@@ -110,7 +124,7 @@ class LSTMClassifier(object):
       self.lstm_stack_.BpropAndOutp(input_frame=i, output_deriv=o_deriv)
 
   def Update(self):
-    self.lstm_stack_.Update()
+    self.param_buffer_.Update()
 
   def Validate(self, data):
     data.Reset()
@@ -133,31 +147,55 @@ class LSTMClassifier(object):
     correct, pooled_correct = data.GetResults(preds)
     return correct, pooled_correct
 
+  # Sets up the model to only validate on data, see validation_worker.py.
+  def SetUpValidation(self, data):
+    self.num_dims_ = self.lstm_stack_.GetInputDims()
+    self.num_output_dims_ = self.lstm_stack_.GetOutputDims()
+    self.SetBatchSize(data.GetBatchSize(), data.GetSeqLength(), train=False)
+
   # Note that both train and valid should have the same batch_size
-  def SetBatchSize(self, batch_size, seq_length):
+  # train=False sets the LSTMs up for inference only, see LSTM.SetBatchSize.
+  def SetBatchSize(self, batch_size, seq_length, train=True):
     self.batch_size_ = batch_size
     self.seq_length_ = seq_length
-    self.lstm_stack_.SetBatchSize(batch_size, seq_length)
+    self.project_inputs_ = self.model_.project_inputs and train and self.model_.checkpoint_states_every == 0
+    self.stream_ = self.model_.stream_training and train
+    self.lstm_stack_.SetBatchSize(batch_size, seq_length, project_inputs=self.project_inputs_, train=train,
+                                  carry_state=self.stream_)
     self.v_ = cm.empty((batch_size, seq_length * self.num_dims_))
     self.o_ = cm.empty((batch_size, seq_length * self.num_output_dims_))
-    self.o_deriv_ = cm.empty((batch_size, seq_length * self.num_output_dims_))
+    if train:
+      self.o_deriv_ = cm.empty((batch_size, seq_length * self.num_output_dims_))
     self.avg_o_ = cm.empty((batch_size, self.num_output_dims_))
     self.target_ = cm.empty((batch_size, 1))
     self.c_ = cm.empty((batch_size, 1))
+    if self.stream_:
+      self.reset_ = cm.empty((batch_size, 1))
 
+  # While training this only snapshots the params, the CheckpointWriter
+  # writes them in the background.
   def Save(self, model_file):
     sys.stdout.write(' Writing model to %s' % model_file)
+    if self.checkpoint_writer_ is not None:
+      self.checkpoint_writer_.Write(model_file)
+      return
     f = h5py.File(model_file, 'w')
     self.lstm_stack_.Save(f)
     f.close()
 
-  def Train(self, train_data, valid_data=None):
+  # With a GradientAverager this is one worker of data parallel training, see
+  # data_parallel.py. Only worker 0 writes the model, validates and displays.
+  # With a ValidationWorker it validates, instead of on valid_data, and writes
+  # the best model.
+  def Train(self, train_data, valid_data=None, averager=None, validation_worker=None):
+    leader = averager is None or averager.GetRank() == 0
     # Timestamp the model that we are training.
     st = datetime.datetime.fromtimestamp(time.time()).strftime('%Y%m%d%H%M%S')
     model_file = os.path.join(self.model_.checkpoint_dir, '%s_%s' % (self.model_.name, st))
     self.model_.timestamp.append(st)
-    print 'Model saved at %s.pbtxt' % model_file
-    WritePbtxt(self.model_, '%s.pbtxt' % model_file)
+    if leader:
+      print 'Model saved at %s.pbtxt' % model_file
+      WritePbtxt(self.model_, '%s.pbtxt' % model_file)
    
     self.num_dims_ = self.lstm_stack_.GetInputDims()
     self.num_output_dims_ = self.lstm_stack_.GetOutputDims()
@@ -165,25 +203,34 @@ class LSTMClassifier(object):
     seq_length = train_data.GetSeqLength()
 
     self.SetBatchSize(batch_size, seq_length)
+    if averager is not None:
+      averager.Broadcast(self.param_buffer_.GetW())
 
     loss = 0
     temp_loss = loss
     best_val_loss = False
     print_after = self.model_.print_after
     validate_after = self.model_.validate_after
-    validate = validate_after > 0 and valid_data is not None
+    validate = validate_after > 0 and (valid_data is not None or validation_worker is not None)
     save_after = self.model_.save_after
-    save = save_after > 0
+    save = save_after > 0 and leader
     display_after = self.model_.display_after
-    display = display_after > 0
+    display = display_after > 0 and leader
     temp_valid_loss = 0
+    if save:
+      # before the data handlers start their threads, the writer is forked
+      self.checkpoint_writer_ = CheckpointWriter(self.param_buffer_, self.lstm_stack_.GetParams())
 
     for ii in xrange(1, self.model_.max_iters + 1):
       newline = False
       sys.stdout.write('\rStep %d' % ii)
       sys.stdout.flush()
 
-      v_cpu, t_cpu = train_data.GetBatch()
+      if self.stream_:
+        v_cpu, t_cpu, reset_cpu = train_data.GetStreamBatch()
+        self.reset_.overwrite(reset_cpu)
+      else:
+        v_cpu, t_cpu = train_data.GetBatch()
       self.v_.overwrite(v_cpu)
       self.target_.overwrite(t_cpu)
 
@@ -195,6 +242,9 @@ class LSTMClassifier(object):
       if ii % print_after == 0:
         loss /= print_after
         sys.stdout.write(' Acc %.5f' % loss)
+        if isinstance(train_data, PrefetchingDataHandler):
+          wait_time, queue_depth = train_data.GetStats()
+          sys.stdout.write(' Wait %.1fms Ready %.1f' % (wait_time * 1000, queue_depth))
         temp_loss = loss
         loss = 0
         newline = True
@@ -202,44 +252,81 @@ class LSTMClassifier(object):
       # compute derivatives for softmax -> compute derivatives for lstm layers
       self.ComputeDeriv()
       self.BpropAndOutp()
+      if averager is not None:
+        averager.Average(self.param_buffer_.GetdW())
       self.Update()
 
       if display and ii % display_after == 0:
         self.lstm_stack_.Display()
 
       if validate and ii % validate_after == 0:
-        valid_loss, valid_loss_pooled = self.Validate(valid_data)
-        if valid_loss_pooled > temp_valid_loss:
-          best_val_loss = True
-          temp_valid_loss = valid_loss_pooled
+        if validation_worker is not None:
+          validation_worker.Validate(self.param_buffer_.GetW(), ii)
         else:
-          best_val_loss = False
-        temp_loss = 0
-        sys.stdout.write(' Valid Acc %.5f ; Pooled Valid Acc %.5f' % (valid_loss, valid_loss_pooled))
-        newline = True
+          valid_loss, valid_loss_pooled = self.Validate(valid_data)
+          if valid_loss_pooled > temp_valid_loss:
+            best_val_loss = True
+            temp_valid_loss = valid_loss_pooled
+          else:
+            best_val_loss = False
+          temp_loss = 0
+          sys.stdout.write(' Valid Acc %.5f ; Pooled Valid Acc %.5f' % (valid_loss, valid_loss_pooled))
+          newline = True
+      if validation_worker is not None:
+        result = validation_worker.GetResult(wait=ii == self.model_.max_iters)
+        if result is not None:
+          step, (valid_loss, valid_loss_pooled) = result
+          if valid_loss_pooled > temp_valid_loss:
+            best_val_loss = True
+            temp_valid_loss = valid_loss_pooled
+          sys.stdout.write(' Valid Acc %.5f ; Pooled Valid Acc %.5f of step %d' % (valid_loss, valid_loss_pooled, step))
+          newline = True
 
       if save and ii % save_after == 0:
         self.Save('%s.h5' % model_file)
       if save and best_val_loss == True:
-        self.Save('%s_best.h5' % model_file)
+        if validation_worker is not None:
+          # the params of the validated step, which the worker still has
+          sys.stdout.write(' Writing model to %s_best.h5' % model_file)
+          validation_worker.Save('%s_best.h5' % model_file)
+        else:
+          self.Save('%s_best.h5' % model_file)
         best_val_loss = False
       if newline:
         sys.stdout.write('\n')
 
+    if self.checkpoint_writer_ is not None:
+      self.checkpoint_writer_.Close()
+      self.checkpoint_writer_ = None
     sys.stdout.write('\n')
 
 def main():
   model = ReadModelProto(sys.argv[1])
-  lstm_classifier = LSTMClassifier(model)
-  train_data = DataHandler(ReadDataProto(sys.argv[2]))
-  valid_data = DataHandler(ReadDataProto(sys.argv[3]))
-  lstm_classifier.Train(train_data, valid_data)
-
-if __name__ == '__main__':
+  train_data_pb = ReadDataProto(sys.argv[2])
+  valid_data_pb = ReadDataProto(sys.argv[3])
   board_id = int(sys.argv[4])
+  if model.num_workers > 1:
+    TrainDataParallel(LSTMClassifier, model, train_data_pb, valid_data_pb, board=board_id, seed=42)
+    return
+
+  validation_worker = None
+  if model.validate_async:
+    validation_worker = ValidationWorker(LSTMClassifier, model, valid_data_pb, board=board_id)
+
   board = LockGPU(board=board_id)
   print 'Using board', board
   
   cm.CUDAMatrix.init_random(42)
   np.random.seed(42)
+  lstm_classifier = LSTMClassifier(model)
+  train_data = ChooseDataHandler(train_data_pb)
+  if validation_worker is None:
+    lstm_classifier.Train(train_data, ChooseDataHandler(valid_data_pb))
+    return
+  try:
+    lstm_classifier.Train(train_data, validation_worker=validation_worker)
+  finally:
+    validation_worker.Close()
+
+if __name__ == '__main__':
   main()
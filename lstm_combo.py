@@ -1,4 +1,6 @@
 from data_handler import *
+from data_parallel import TrainDataParallel
+from validation_worker import ValidationWorker
 import lstm
 
 
@@ -6,9 +8,9 @@ class LSTMCombo(object):
   def __init__(self, model):
     self.model_ = model
     
-    self.lstm_stack_enc_ = lstm.LSTMStack()
-    self.lstm_stack_dec_ = lstm.LSTMStack()
-    self.lstm_stack_fut_ = lstm.LSTMStack()
+    self.lstm_stack_enc_ = lstm.LSTMStack(checkpoint_every=model.checkpoint_states_every)
+    self.lstm_stack_dec_ = lstm.LSTMStack(checkpoint_every=model.checkpoint_states_every)
+    self.lstm_stack_fut_ = lstm.LSTMStack(checkpoint_every=model.checkpoint_states_every)
     
     self.decoder_copy_init_state_ = model.decoder_copy_init_state
     self.future_copy_init_state_  = model.future_copy_init_state
@@ -37,6 +39,10 @@ class LSTMCombo(object):
     self.binary_data_ = model.binary_data or model.squash_relu
     self.squash_relu_lambda_ = model.squash_relu_lambda
     self.relu_data_ = model.relu_data
+
+    params = self.lstm_stack_enc_.GetParams() + self.lstm_stack_dec_.GetParams() + self.lstm_stack_fut_.GetParams()
+    self.param_buffer_ = ParamBuffer([param for _, param in params], optimizer=model.optimizer)
+    self.checkpoint_writer_ = None
     
     # load model if available
     if len(model.timestamp) > 0:
@@ -48,31 +54,51 @@ class LSTMCombo(object):
       self.lstm_stack_fut_.Load(f)
       f.close()
 
+  # Number of weights of LSTMCombo(model), without allocating them.
+  @staticmethod
+  def GetNumParams(model):
+    lstms = list(model.lstm)
+    if model.dec_seq_length > 0:
+      lstms.extend(model.lstm_dec)
+    if model.future_seq_length > 0:
+      lstms.extend(model.lstm_future)
+    return sum(lstm.LSTM.GetNumParams(l) for l in lstms)
+
   def Fprop(self, train=False):
     if self.squash_relu_:
       self.v_.apply_relu_squash(lambdaa=self.squash_relu_lambda_)
     self.lstm_stack_enc_.Reset()
     self.lstm_stack_dec_.Reset()
     self.lstm_stack_fut_.Reset()
+    if train and self.stream_:
+      self.lstm_stack_enc_.CarryState(self.reset_)
 
     # Fprop through encoder.
+    enc_input_frames = [self.GetFrame(self.v_, t) for t in xrange(self.enc_seq_length_)]
+    if self.project_inputs_:
+      self.lstm_stack_enc_.ProjectInputs(enc_input_frames)
     for t in xrange(self.enc_seq_length_):
-      self.lstm_stack_enc_.Fprop(input_frame=self.v_.col_slice(t * self.num_dims_, (t+1) * self.num_dims_))
+      self.lstm_stack_enc_.Fprop(input_frame=enc_input_frames[t])
     
     init_state = self.lstm_stack_enc_.GetAllCurrentStates()
 
     # Fprop through decoder.
+    dec_input_frames = [None] * self.dec_seq_length_
+    if self.is_conditional_dec_:
+      for t in xrange(1, self.dec_seq_length_):
+        dec_input_frames[t] = self.GetFrame(self.v_, self.enc_seq_length_ - t)
+      if self.project_inputs_:
+        self.lstm_stack_dec_.ProjectInputs(dec_input_frames)
     for t in xrange(self.dec_seq_length_):
       this_init_state = init_state if t == 0 else []
-      if self.is_conditional_dec_ and t > 0:
-        t2 = self.enc_seq_length_ - t
-        input_frame=self.v_.col_slice(t2 * self.num_dims_, (t2+1) * self.num_dims_)
-      else:
-        input_frame = None
-      self.lstm_stack_dec_.Fprop(input_frame=input_frame, init_state=this_init_state,
-                                 output_frame=self.v_dec_.col_slice(t * self.num_dims_, (t+1) * self.num_dims_), copy_init_state=self.decoder_copy_init_state_)
+      self.lstm_stack_dec_.Fprop(input_frame=dec_input_frames[t], init_state=this_init_state,
+                                 output_frame=self.GetFrame(self.v_dec_, t), copy_init_state=self.decoder_copy_init_state_)
 
     # Fprop through future predictor.
+    # At test time it is conditioned on its own outputs, which are not known in advance.
+    if self.is_conditional_fut_ and train and self.project_inputs_:
+      fut_input_frames = [None] + [self.GetFrame(self.v_, self.enc_seq_length_ + t - 1) for t in xrange(1, self.future_seq_length_)]
+      self.lstm_stack_fut_.ProjectInputs(fut_input_frames)
     for t in xrange(self.future_seq_length_):
       this_init_state = init_state if t == 0 else []
       if self.is_conditional_fut_ and t > 0:
@@ -104,6 +130,9 @@ class LSTMCombo(object):
       if self.future_seq_length_ > 0:
         self.v_fut_.lower_bound(0)
 
+  def GetFrame(self, v, t):
+    return v.col_slice(t * self.num_dims_, (t+1) * self.num_dims_)
+
   def BpropAndOutp(self):
     if self.binary_data_:
       pass
@@ -149,9 +178,7 @@ class LSTMCombo(object):
       self.lstm_stack_enc_.BpropAndOutp(input_frame=self.v_.col_slice(t * self.num_dims_, (t+1) * self.num_dims_))
 
   def Update(self):
-    self.lstm_stack_enc_.Update()
-    self.lstm_stack_dec_.Update()
-    self.lstm_stack_fut_.Update()
+    self.param_buffer_.Update()
 
   def ComputeDeriv(self):
     for t in xrange(self.dec_seq_length_):
@@ -227,7 +254,12 @@ class LSTMCombo(object):
     loss_fut = loss_fut / num_batches
     return loss_dec, loss_fut
 
-  def SetBatchSize(self, train_data):
+  # Sets up the model to only validate on data, see validation_worker.py.
+  def SetUpValidation(self, data):
+    self.SetBatchSize(data, train=False)
+
+  # train=False sets the LSTMs up for inference only, see LSTM.SetBatchSize.
+  def SetBatchSize(self, train_data, train=True):
    
     self.num_dims_ = train_data.GetDims()
     batch_size = train_data.GetBatchSize()
@@ -240,20 +272,33 @@ class LSTMCombo(object):
     self.enc_seq_length_    = seq_length - future_seq_length
     self.dec_seq_length_    = dec_seq_length
     self.future_seq_length_ = future_seq_length
-    self.lstm_stack_enc_.SetBatchSize(batch_size, self.enc_seq_length_)
+    self.project_inputs_ = self.model_.project_inputs and train and self.model_.checkpoint_states_every == 0
+    # only the encoder carries its state over, decoder and future predictor start from it
+    self.stream_ = self.model_.stream_training and train
+    self.lstm_stack_enc_.SetBatchSize(batch_size, self.enc_seq_length_,
+                                     project_inputs=self.project_inputs_, train=train, carry_state=self.stream_)
     self.v_ = cm.empty((batch_size, seq_length * self.num_dims_))
+    if self.stream_:
+      self.reset_ = cm.empty((batch_size, 1))
     if dec_seq_length > 0:
-      self.lstm_stack_dec_.SetBatchSize(batch_size, dec_seq_length)
+      self.lstm_stack_dec_.SetBatchSize(batch_size, dec_seq_length,
+                                       project_inputs=self.project_inputs_ and self.is_conditional_dec_, train=train)
       self.v_dec_ = cm.empty((batch_size, dec_seq_length * self.num_dims_))
       self.v_dec_deriv_ = cm.empty((batch_size, dec_seq_length * self.num_dims_))
 
     if future_seq_length > 0:
-      self.lstm_stack_fut_.SetBatchSize(batch_size, future_seq_length)
+      self.lstm_stack_fut_.SetBatchSize(batch_size, future_seq_length,
+                                       project_inputs=self.project_inputs_ and self.is_conditional_fut_, train=train)
       self.v_fut_ = cm.empty((batch_size, future_seq_length * self.num_dims_))
       self.v_fut_deriv_ = cm.empty((batch_size, future_seq_length * self.num_dims_))
 
+  # While training this only snapshots the params, the CheckpointWriter
+  # writes them in the background.
   def Save(self, model_file):
     sys.stdout.write(' Writing model to %s' % model_file)
+    if self.checkpoint_writer_ is not None:
+      self.checkpoint_writer_.Write(model_file)
+      return
     f = h5py.File(model_file, 'w')
     self.lstm_stack_enc_.Save(f)
     self.lstm_stack_dec_.Save(f)
@@ -274,7 +319,7 @@ class LSTMCombo(object):
 
   def Show(self, data, output_dir=None):
     # get random batch from the data and displays the results
-    self.SetBatchSize(data)
+    self.SetBatchSize(data, train=False)
     data.Reset()
 
     v_cpu, _ = data.GetBatch()
@@ -294,7 +339,7 @@ class LSTMCombo(object):
     data.DisplayData(v_cpu, rec=rec, fut=fut, case_id=rand_index, output_file=output_file)
 
   def RunAndShow(self, data, output_dir=None, max_dataset_size=0):
-    self.SetBatchSize(data)
+    self.SetBatchSize(data, train=False)
     data.Reset()
     dataset_size = data.GetDatasetSize()
     if max_dataset_size > 0 and dataset_size > max_dataset_size:
@@ -320,31 +365,46 @@ class LSTMCombo(object):
       if end:
         break
   
-  def Train(self, train_data, valid_data=None):
+  # With a GradientAverager this is one worker of data parallel training, see
+  # data_parallel.py. Only worker 0 writes the model, validates and displays.
+  # With a ValidationWorker it validates, instead of on valid_data.
+  def Train(self, train_data, valid_data=None, averager=None, validation_worker=None):
+    leader = averager is None or averager.GetRank() == 0
     # Timestamp the model that we are training.
     st = datetime.datetime.fromtimestamp(time.time()).strftime('%Y%m%d%H%M%S')
     model_file = os.path.join(self.model_.checkpoint_dir, '%s_%s' % (self.model_.name, st))
     self.model_.timestamp.append(st)
-    print 'Model saved at %s.pbtxt' % model_file
-    WritePbtxt(self.model_, '%s.pbtxt' % model_file)
+    if leader:
+      print 'Model saved at %s.pbtxt' % model_file
+      WritePbtxt(self.model_, '%s.pbtxt' % model_file)
    
     self.SetBatchSize(train_data)
+    if averager is not None:
+      averager.Broadcast(self.param_buffer_.GetW())
 
     loss_dec = 0
     loss_fut = 0
     print_after = self.model_.print_after
     validate_after = self.model_.validate_after
-    validate = validate_after > 0 and valid_data is not None
+    validate = validate_after > 0 and (valid_data is not None or validation_worker is not None)
     save_after = self.model_.save_after
-    save = save_after > 0
+    save = save_after > 0 and leader
     display_after = self.model_.display_after
-    display = display_after > 0
+    display = display_after > 0 and leader
+    if save:
+      # before the data handlers start their threads, the writer is forked
+      params = self.lstm_stack_enc_.GetParams() + self.lstm_stack_dec_.GetParams() + self.lstm_stack_fut_.GetParams()
+      self.checkpoint_writer_ = CheckpointWriter(self.param_buffer_, params)
 
     for ii in xrange(1, self.model_.max_iters + 1):
       newline = False
       sys.stdout.write('\rStep %d' % ii)
       sys.stdout.flush()
-      v_cpu, _ = train_data.GetBatch()
+      if self.stream_:
+        v_cpu, _, reset_cpu = train_data.GetStreamBatch()
+        self.reset_.overwrite(reset_cpu)
+      else:
+        v_cpu, _ = train_data.GetBatch()
       self.v_.overwrite(v_cpu)
       self.Fprop(train=True)
 
@@ -362,11 +422,16 @@ class LSTMCombo(object):
         loss_dec /= print_after
         loss_fut /= print_after
         sys.stdout.write(' Dec %.5f Fut %.5f' % (loss_dec, loss_fut))
+        if isinstance(train_data, PrefetchingDataHandler):
+          wait_time, queue_depth = train_data.GetStats()
+          sys.stdout.write(' Wait %.1fms Ready %.1f' % (wait_time * 1000, queue_depth))
         loss_dec = 0
         loss_fut = 0
         newline = True
 
       self.BpropAndOutp()
+      if averager is not None:
+        averager.Average(self.param_buffer_.GetdW())
       self.Update()
 
       if display and ii % display_after == 0:
@@ -378,30 +443,57 @@ class LSTMCombo(object):
         #self.lstm_stack_dec_.Display()
 
       if validate and ii % validate_after == 0:
-        valid_loss_dec, valid_loss_fut = self.Validate(valid_data)
-        sys.stdout.write(' VDec %.5f VFut %.5f' % (valid_loss_dec, valid_loss_fut))
-        newline = True
+        if validation_worker is not None:
+          validation_worker.Validate(self.param_buffer_.GetW(), ii)
+        else:
+          valid_loss_dec, valid_loss_fut = self.Validate(valid_data)
+          sys.stdout.write(' VDec %.5f VFut %.5f' % (valid_loss_dec, valid_loss_fut))
+          newline = True
+      if validation_worker is not None:
+        result = validation_worker.GetResult(wait=ii == self.model_.max_iters)
+        if result is not None:
+          step, (valid_loss_dec, valid_loss_fut) = result
+          sys.stdout.write(' VDec %.5f VFut %.5f of step %d' % (valid_loss_dec, valid_loss_fut, step))
+          newline = True
 
       if save and ii % save_after == 0:
         self.Save('%s.h5' % model_file)
       if newline:
         sys.stdout.write('\n')
 
+    if self.checkpoint_writer_ is not None:
+      self.checkpoint_writer_.Close()
+      self.checkpoint_writer_ = None
     sys.stdout.write('\n')
 
 def main():
   model = ReadModelProto(sys.argv[1])
-  lstm_autoencoder = LSTMCombo(model)
-  train_data = ChooseDataHandler(ReadDataProto(sys.argv[2]))
-  valid_data = ChooseDataHandler(ReadDataProto(sys.argv[3]))
-  lstm_autoencoder.Train(train_data, valid_data)
+  train_data_pb = ReadDataProto(sys.argv[2])
+  valid_data_pb = ReadDataProto(sys.argv[3])
+  board_id = int(sys.argv[4])
+  if model.num_workers > 1:
+    TrainDataParallel(LSTMCombo, model, train_data_pb, valid_data_pb, board=board_id, seed=42)
+    return
+
+  validation_worker = None
+  if model.validate_async:
+    validation_worker = ValidationWorker(LSTMCombo, model, valid_data_pb, board=board_id)
 
-if __name__ == '__main__':
   # Set the board
-  board_id = int(sys.argv[4])
   board = LockGPU(board=board_id)
   print 'Using board', board
 
   cm.CUDAMatrix.init_random(42)
   np.random.seed(42)
+  lstm_autoencoder = LSTMCombo(model)
+  train_data = ChooseDataHandler(train_data_pb)
+  if validation_worker is None:
+    lstm_autoencoder.Train(train_data, ChooseDataHandler(valid_data_pb))
+    return
+  try:
+    lstm_autoencoder.Train(train_data, validation_worker=validation_worker)
+  finally:
+    validation_worker.Close()
+
+if __name__ == '__main__':
   main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The tests run on the NumPy backend, see cudamat/__init__.py, and need
+# config_pb2 compiled from config.proto in the top level directory.
+os.environ.setdefault('CUDAMAT_BACKEND', 'cpu')
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,68 @@
+# The ways of saving memory in training, checkpoint_states_every, store_only_hc
+# and project_inputs, must give the same gradients as keeping everything.
+import numpy as np
+import pytest
+import cudamat as cm
+import config_pb2
+from google.protobuf import text_format
+from lstm_combo import LSTMCombo
+
+B, D, NUM_HID, T = 4, 6, 8, 5
+
+def ParamConfig(init='UNIFORM', scale=0.1):
+  return 'init_type: %s scale: %g epsilon: 0.01 momentum: 0.9' % (init, scale)
+
+def LSTMConfig(name, num_inputs, extra):
+  return ('name: "%s" num_hid: %d has_input: true input_dims: %d w_dense { %s } w_diag { %s } b { %s } '
+          'w_input { %s } %s' % (name, NUM_HID, num_inputs, ParamConfig(), ParamConfig(),
+                                 ParamConfig('CONSTANT', 0.0), ParamConfig(), extra))
+
+def OutputLSTMConfig(name, extra):
+  return LSTMConfig(name, NUM_HID, 'has_output: true output_dims: %d w_output { %s } b_output { %s } %s' % (
+    D, ParamConfig(), ParamConfig('CONSTANT', 0.0), extra))
+
+def Model(lstm_extra='', model_extra=''):
+  s = ('name: "m" dec_seq_length: %d future_seq_length: %d dec_conditional: true future_conditional: true '
+       'logreg { name: "x" num_inputs: 1 num_outputs: 1 } %s ' % (T, T, model_extra))
+  s += 'lstm { %s } lstm { %s } ' % (LSTMConfig('e0', D, lstm_extra), LSTMConfig('e1', NUM_HID, lstm_extra))
+  for stack in ['lstm_dec', 'lstm_future']:
+    s += '%s { %s } %s { %s } ' % (stack, LSTMConfig(stack + '0', D, lstm_extra),
+                                   stack, OutputLSTMConfig(stack + '1', lstm_extra))
+  model = config_pb2.Model()
+  text_format.Merge(s, model)
+  return model
+
+class Data(object):
+  def GetBatchSize(self):
+    return B
+  def GetDims(self):
+    return D
+  def GetSeqLength(self):
+    return 2 * T
+
+def GetGradient(model):
+  cm.CUDAMatrix.init_random(1)
+  np.random.seed(1)
+  net = LSTMCombo(model)
+  net.SetBatchSize(Data())
+  v = np.random.RandomState(2).rand(B, 2 * T * D).astype(np.float32)
+  net.v_.overwrite(v)
+  net.Fprop(train=True)
+  net.GetLoss()
+  net.BpropAndOutp()
+  return net.param_buffer_.GetdW().asarray()
+
+@pytest.mark.parametrize('lstm_extra, model_extra', [
+  ('', 'checkpoint_states_every: 2'),  # segments of 2, 2 and 1
+  ('', 'checkpoint_states_every: 3'),  # segments of 3 and 2
+  ('store_only_hc: true', ''),
+  ('', 'project_inputs: true'),
+  ('use_relu: true', 'checkpoint_states_every: 2'),
+  ('use_relu: true store_only_hc: true', ''),
+])
+def test_same_gradient_as_default(lstm_extra, model_extra):
+  relu = 'use_relu: true' if 'use_relu' in lstm_extra else ''
+  expected = GetGradient(Model(relu))
+  dw = GetGradient(Model(lstm_extra, model_extra))
+  assert np.abs(expected).max() > 0
+  assert np.allclose(dw, expected, rtol=1e-4, atol=1e-6)
@@ -0,0 +1,194 @@
+# Checks the LSTM and optimizer kernels of the NumPy backend against the
+# plain NumPy formulas, in float64.
+import numpy as np
+import pytest
+import cudamat as cm
+
+N, B = 3, 5  # lstms, cases
+
+def Sigmoid(x):
+  return 1 / (1 + np.exp(-x))
+
+def RandomLSTM(rng, use_relu):
+  w_dense = rng.randn(4 * N, N) * 0.5
+  w_diag = rng.randn(1, 3 * N) * 0.5
+  b = rng.randn(1, 4 * N) * 0.5
+  s_in = rng.randn(B, 6 * N)
+  if use_relu:
+    # c never goes below zero with relu units
+    s_in[:, N:2*N] = np.abs(s_in[:, N:2*N])
+  gates = rng.randn(B, 4 * N)  # input projection already in s_out
+  return w_dense, w_diag, b, s_in, gates
+
+# h, c, i, f, a, o of one step.
+def Fprop(w_dense, w_diag, b, s_in, gates, use_relu, init):
+  h_in, c_in = s_in[:, :N], s_in[:, N:2*N]
+  pre = gates + b
+  if not init:
+    pre = pre + h_in.dot(w_dense.T)
+  wi, wf, wo = w_diag[:, :N], w_diag[:, N:2*N], w_diag[:, 2*N:]
+  i = Sigmoid(pre[:, :N] + (0 if init else c_in * wi))
+  f = Sigmoid(pre[:, N:2*N] + (0 if init else c_in * wf))
+  a = np.maximum(pre[:, 2*N:3*N], 0) if use_relu else np.tanh(pre[:, 2*N:3*N])
+  c = i * a + (0 if init else f * c_in)
+  o = Sigmoid(pre[:, 3*N:] + c * wo)
+  h = o * c if use_relu else o * np.tanh(c)
+  return np.hstack([h, c, i, f, a, o])
+
+# Derivs wrt the gate pre-activations and wrt h_in and c_in, given the derivs
+# wrt h and c.
+def Bprop(w_dense, w_diag, s_in, s_out, grad_h, grad_c_out, use_relu, init):
+  c_in = s_in[:, N:2*N]
+  h, c, i, f, a, o = [s_out[:, k*N:(k+1)*N] for k in xrange(6)]
+  wi, wf, wo = w_diag[:, :N], w_diag[:, N:2*N], w_diag[:, 2*N:]
+  act_c = c if use_relu else np.tanh(c)
+  dact_c = (c > 0).astype(np.float64) if use_relu else 1 - act_c ** 2
+  da = (a > 0).astype(np.float64) if use_relu else 1 - a ** 2
+  grad_o = grad_h * act_c * o * (1 - o)
+  grad_c = grad_c_out + grad_h * o * dact_c + grad_o * wo
+  grad_a = grad_c * i * da
+  grad_i = grad_c * a * i * (1 - i)
+  grad_f = np.zeros_like(grad_i) if init else grad_c * c_in * f * (1 - f)
+  grad_gates = np.hstack([grad_i, grad_f, grad_a, grad_o])
+  grad_h_in = grad_gates.dot(w_dense)
+  grad_c_in = grad_c * f + grad_f * wf + grad_i * wi
+  return grad_gates, grad_h_in, grad_c_in
+
+def Mat(x):
+  return cm.CUDAMatrix(np.array(x, dtype=np.float32))
+
+@pytest.mark.parametrize('use_relu', [False, True])
+@pytest.mark.parametrize('init', [False, True])
+def test_lstm_fprop(use_relu, init):
+  rng = np.random.RandomState(1)
+  w_dense, w_diag, b, s_in, gates = RandomLSTM(rng, use_relu)
+  s_out = Mat(np.hstack([rng.randn(B, 2 * N), gates]))
+  cm.lstm_fprop(Mat(s_in), s_out, Mat(w_dense), Mat(w_diag), Mat(b), use_relu=use_relu, init=init)
+  expected = Fprop(w_dense, w_diag, b, s_in, gates, use_relu, init)
+  assert np.allclose(s_out.asarray(), expected, atol=1e-5)
+
+@pytest.mark.parametrize('use_relu', [False, True])
+@pytest.mark.parametrize('init', [False, True])
+def test_lstm_bprop(use_relu, init):
+  rng = np.random.RandomState(2)
+  w_dense, w_diag, b, s_in, gates = RandomLSTM(rng, use_relu)
+  s_out = Fprop(w_dense, w_diag, b, s_in, gates, use_relu, init)
+  grad_h, grad_c_out = rng.randn(B, N), rng.randn(B, N)
+  d_in_before = rng.randn(B, 6 * N)
+  d_in = Mat(d_in_before)
+  d_out = Mat(np.hstack([grad_h, grad_c_out, np.zeros((B, 4 * N))]))
+  cm.lstm_bprop(Mat(s_in), Mat(s_out), d_in, d_out, Mat(w_dense), Mat(w_diag), use_relu=use_relu, init=init)
+  grad_gates, grad_h_in, grad_c_in = Bprop(w_dense, w_diag, s_in, s_out, grad_h, grad_c_out, use_relu, init)
+  assert np.allclose(d_out.asarray()[:, 2*N:], grad_gates, atol=1e-5)
+  if init:
+    assert np.allclose(d_in.asarray(), d_in_before, atol=1e-6)
+  else:
+    # the deriv wrt h_in is added, the one wrt c_in written
+    assert np.allclose(d_in.asarray()[:, :N], d_in_before[:, :N] + grad_h_in, atol=1e-5)
+    assert np.allclose(d_in.asarray()[:, N:2*N], grad_c_in, atol=1e-5)
+
+# The reference Bprop is the derivative of the reference Fprop.
+@pytest.mark.parametrize('use_relu', [False, True])
+def test_reference_bprop_matches_finite_differences(use_relu):
+  rng = np.random.RandomState(3)
+  w_dense, w_diag, b, s_in, gates = RandomLSTM(rng, use_relu)
+  grad_h, grad_c_out = rng.randn(B, N), rng.randn(B, N)
+  def Loss(s_in, gates):
+    s = Fprop(w_dense, w_diag, b, s_in, gates, use_relu, False)
+    return (s[:, :N] * grad_h).sum() + (s[:, N:2*N] * grad_c_out).sum()
+  s_out = Fprop(w_dense, w_diag, b, s_in, gates, use_relu, False)
+  grad_gates, grad_h_in, grad_c_in = Bprop(w_dense, w_diag, s_in, s_out, grad_h, grad_c_out, use_relu, False)
+  analytic = np.hstack([grad_h_in, grad_c_in])
+  eps = 1e-6
+  for x, expected in [(gates, grad_gates), (s_in[:, :2*N], analytic)]:
+    numerical = np.zeros_like(expected)
+    for idx in np.ndindex(*expected.shape):
+      old = x[idx]
+      x[idx] = old + eps
+      l1 = Loss(s_in, gates)
+      x[idx] = old - eps
+      l2 = Loss(s_in, gates)
+      x[idx] = old
+      numerical[idx] = (l1 - l2) / (2 * eps)
+    assert np.allclose(numerical, expected, atol=1e-5)
+
+@pytest.mark.parametrize('init', [False, True])
+def test_lstm_outp(init):
+  rng = np.random.RandomState(4)
+  s_in, s_out, d_out = rng.randn(B, 6 * N), rng.randn(B, 6 * N), rng.randn(B, 6 * N)
+  dw_dense_before, dw_diag_before, db_before = rng.randn(4 * N, N), rng.randn(1, 3 * N), rng.randn(1, 4 * N)
+  dw_dense, dw_diag, db = Mat(dw_dense_before), Mat(dw_diag_before), Mat(db_before)
+  cm.lstm_outp(Mat(s_in), Mat(s_out), Mat(d_out), dw_dense, dw_diag, db, init=init)
+  grad_gates = d_out[:, 2*N:]
+  c_in, c = s_in[:, N:2*N], s_out[:, N:2*N]
+  expected_dense = dw_dense_before + (0 if init else grad_gates.T.dot(s_in[:, :N]))
+  peephole_i = (c_in * grad_gates[:, :N]).sum(axis=0, keepdims=True)
+  peephole_f = (c_in * grad_gates[:, N:2*N]).sum(axis=0, keepdims=True)
+  if init:
+    peephole_i, peephole_f = np.zeros((1, N)), np.zeros((1, N))
+  expected_diag = dw_diag_before + np.hstack([peephole_i, peephole_f,
+                                              (c * grad_gates[:, 3*N:]).sum(axis=0, keepdims=True)])
+  assert np.allclose(dw_dense.asarray(), expected_dense, atol=1e-5)
+  assert np.allclose(dw_diag.asarray(), expected_diag, atol=1e-5)
+  assert np.allclose(db.asarray(), db_before + grad_gates.sum(axis=0, keepdims=True), atol=1e-5)
+
+@pytest.mark.parametrize('l2_decay, gradient_clip', [(0., 0.), (0.1, 0.05)])
+def test_momentum_update(l2_decay, gradient_clip):
+  rng = np.random.RandomState(5)
+  w, h = rng.randn(4, 3), rng.randn(4, 3)
+  w_mat, h_mat = Mat(w), Mat(h)
+  for step in xrange(3):
+    g = rng.randn(4, 3)
+    cm.momentum_update(w_mat, Mat(g), h_mat, 0.1, 0.9, l2_decay=l2_decay, gradient_clip=gradient_clip)
+    h = 0.9 * h - 0.1 * (g + l2_decay * w)
+    if gradient_clip > 0:
+      h = np.clip(h, -gradient_clip, gradient_clip)
+    w = w + h
+  assert np.allclose(w_mat.asarray(), w, atol=1e-5)
+  assert np.allclose(h_mat.asarray(), h, atol=1e-5)
+
+@pytest.mark.parametrize('l2_decay, gradient_clip', [(0., 0.), (0.1, 0.05)])
+def test_rmsprop_update(l2_decay, gradient_clip):
+  rng = np.random.RandomState(6)
+  w, v = rng.randn(4, 3), np.zeros((4, 3))
+  w_mat, v_mat = Mat(w), Mat(v)
+  for step in xrange(3):
+    g = rng.randn(4, 3)
+    cm.rmsprop_update(w_mat, Mat(g), v_mat, 0.01, 0.9, l2_decay=l2_decay, gradient_clip=gradient_clip,
+                      damping=1e-8)
+    g = g + l2_decay * w
+    v = 0.9 * v + 0.1 * g ** 2
+    update = 0.01 * g / (np.sqrt(v) + 1e-8)
+    if gradient_clip > 0:
+      update = np.clip(update, -gradient_clip, gradient_clip)
+    w = w - update
+  assert np.allclose(w_mat.asarray(), w, atol=1e-5)
+  assert np.allclose(v_mat.asarray(), v, atol=1e-5)
+
+@pytest.mark.parametrize('l2_decay, gradient_clip', [(0., 0.), (0.1, 0.05)])
+def test_adam_update(l2_decay, gradient_clip):
+  rng = np.random.RandomState(7)
+  w, m, v = rng.randn(4, 3), np.zeros((4, 3)), np.zeros((4, 3))
+  w_mat, m_mat, v_mat = Mat(w), Mat(m), Mat(v)
+  for step in xrange(3):
+    g = rng.randn(4, 3)
+    cm.adam_update(w_mat, Mat(g), m_mat, v_mat, 0.01, 0.9, 0.999, l2_decay=l2_decay,
+                   gradient_clip=gradient_clip, damping=1e-8)
+    g = g + l2_decay * w
+    m = 0.9 * m + 0.1 * g
+    v = 0.999 * v + 0.001 * g ** 2
+    update = 0.01 * m / (np.sqrt(v) + 1e-8)
+    if gradient_clip > 0:
+      update = np.clip(update, -gradient_clip, gradient_clip)
+    w = w - update
+  assert np.allclose(w_mat.asarray(), w, atol=1e-5)
+  assert np.allclose(m_mat.asarray(), m, atol=1e-5)
+  assert np.allclose(v_mat.asarray(), v, atol=1e-5)
+
+def test_sample_bernoulli_returns_target():
+  cm.CUDAMatrix.init_random(1)
+  p = Mat(np.full((4, 3), 0.5))
+  target = cm.empty((4, 3))
+  assert p.sample_bernoulli(target=target) is target
+  assert set(np.unique(target.asarray())) <= set([0., 1.])
+  assert p.sample_bernoulli() is p
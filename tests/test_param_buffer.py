@@ -0,0 +1,84 @@
+# One fused ParamBuffer.Update must move every param as if it had been updated
+# on its own with its own optimizer, learning rate schedule, l2 decay and clip.
+import numpy as np
+import pytest
+import cudamat as cm
+import config_pb2
+from util import Param, ParamBuffer
+
+P = config_pb2.Param
+STEPS = 5
+
+# optimizer (None takes the one of the buffer), epsilon, momentum, l2_decay,
+# gradient_clip, eps_decay_after
+CONFIGS = [
+  (P.ADAM, 0.1, 0.9, 0., 0., 2),
+  (None, 0.2, 0.5, 0.1, 0.05, 0),
+  (P.RMSPROP, 0.01, 0.9, 0.01, 0., 0),
+  (P.SGD, 0.3, 0., 0., 0., 1),
+  (P.ADAM, 0.1, 0.9, 0., 0., 2),  # same config as the first, same segment
+  (P.RMSPROP, 0.01, 0., 0., 0.001, 0),
+  (P.SGD, 0.05, 0.9, 0.01, 0., 3),
+]
+SHAPES = [(3, 4), (1, 5), (2, 2), (4, 1), (2, 3), (5, 5), (3, 3)]
+
+def Config(optimizer, eps, momentum, l2_decay, gradient_clip, eps_decay_after):
+  config = P()
+  config.init_type = P.GAUSSIAN
+  config.scale = 1
+  if optimizer is not None:
+    config.optimizer = optimizer
+  config.epsilon = eps
+  config.momentum = momentum
+  config.l2_decay = l2_decay
+  config.gradient_clip = gradient_clip
+  config.eps_decay_after = eps_decay_after
+  config.eps_decay_factor = 0.5
+  return config
+
+# The update of one param, in float64. state is (grad or grad_mean, grad_sqr).
+def ReferenceUpdate(optimizer, w, g, state, t, eps, momentum, l2_decay, gradient_clip, eps_decay_after):
+  m, v = state
+  g = g + l2_decay * w
+  if eps_decay_after > 0:
+    eps *= 0.5 ** (t // eps_decay_after)
+  if optimizer == P.SGD:
+    # the clipped step is the history
+    m[...] = momentum * m - eps * g
+    if gradient_clip > 0:
+      m[...] = np.clip(m, -gradient_clip, gradient_clip)
+    step = -m
+  elif optimizer == P.RMSPROP:
+    v[...] = 0.9 * v + 0.1 * g * g
+    step = eps * g / (np.sqrt(v) + 1e-8)
+  else:
+    m[...] = 0.9 * m + 0.1 * g
+    v[...] = 0.999 * v + 0.001 * g * g
+    step = eps * np.sqrt(1 - 0.999 ** (t + 1)) / (1 - 0.9 ** (t + 1)) * m / (np.sqrt(v) + 1e-8)
+  if gradient_clip > 0:
+    step = np.clip(step, -gradient_clip, gradient_clip)
+  return w - step
+
+@pytest.mark.parametrize('default_optimizer', [P.SGD, P.RMSPROP, P.ADAM])
+def test_update_matches_per_param_reference(default_optimizer):
+  cm.CUDAMatrix.init_random(1)
+  rng = np.random.RandomState(1)
+  params = [Param(shape, Config(*config)) for shape, config in zip(SHAPES, CONFIGS)]
+  expected = [p.GetW().asarray().astype(np.float64) for p in params]
+  state = [(np.zeros(shape), np.zeros(shape)) for shape in SHAPES]
+  param_buffer = ParamBuffer(params, optimizer=default_optimizer)
+  assert len(param_buffer.segments_) < len(params)
+  for t in xrange(STEPS):
+    for i, (p, config) in enumerate(zip(params, CONFIGS)):
+      g = rng.randn(*SHAPES[i]).astype(np.float32)
+      p.GetdW().overwrite(g)
+      optimizer = default_optimizer if config[0] is None else config[0]
+      expected[i] = ReferenceUpdate(optimizer, expected[i], g, state[i], t, *config[1:])
+    param_buffer.Update()
+  for p, w, (m, v) in zip(params, expected, state):
+    assert p.t_ == STEPS
+    assert np.allclose(p.GetW().asarray(), w, rtol=1e-5, atol=1e-5)
+    if p.GetOptimizer() == P.SGD:
+      assert np.allclose(p.state_['grad'].asarray(), m, rtol=1e-5, atol=1e-6)
+    else:
+      assert np.allclose(p.state_['grad_sqr'].asarray(), v, rtol=1e-5, atol=1e-6)
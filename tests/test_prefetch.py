@@ -0,0 +1,45 @@
+# Reset of a PrefetchingDataHandler starts the data over, with worker threads
+# and with worker processes.
+import numpy as np
+import pytest
+import config_pb2
+from google.protobuf import text_format
+from data_handler import ChooseDataHandler
+
+# 12 videos split into whole batches over 1, 2 and 3 workers
+NUM_VIDEOS, NUM_FRAMES, IMAGE_SIZE, BATCH_SIZE = 12, 3, 4, 2
+
+def DataConfig(tmpdir, extra):
+  videos = np.arange(NUM_VIDEOS * NUM_FRAMES * IMAGE_SIZE ** 2) % 251
+  data_file = str(tmpdir.join('videos.npy'))
+  np.save(data_file, videos.astype(np.uint8).reshape(NUM_VIDEOS, NUM_FRAMES, IMAGE_SIZE, IMAGE_SIZE))
+  data_pb = config_pb2.Data()
+  text_format.Merge('dataset_type: BOUNCING_MNIST_FIXED data_file: "%s" num_frames: %d image_size: %d '
+                    'batch_size: %d random_seed: 1 %s' % (data_file, NUM_FRAMES, IMAGE_SIZE, BATCH_SIZE, extra),
+                    data_pb)
+  return data_pb
+
+def GetBatches(data, num_batches):
+  return [data.GetBatch()[0].copy() for i in xrange(num_batches)]
+
+@pytest.mark.parametrize('extra', [
+  'num_prefetch_workers: 1',
+  'num_prefetch_workers: 2 prefetch_processes: true',
+  'num_prefetch_workers: 3 prefetch_processes: true prefetch_queue_size: 4',
+])
+def test_reset_starts_over(tmpdir, extra):
+  data = ChooseDataHandler(DataConfig(tmpdir, extra))
+  num_batches = NUM_VIDEOS / BATCH_SIZE
+  try:
+    first = GetBatches(data, num_batches)
+    data.Reset()
+    # reset in the middle of a pass, with batches waiting in the queues
+    assert all((a == b).all() for a, b in zip(GetBatches(data, 2), first))
+    data.Reset()
+    again = GetBatches(data, num_batches)
+  finally:
+    data.Stop()
+  assert all((a == b).all() for a, b in zip(again, first))
+  # every video once
+  rows = set(row.tobytes() for batch in first for row in batch)
+  assert len(rows) == NUM_VIDEOS
@@ -1,11 +1,13 @@
 import sys
+import os
+import multiprocessing
 
 import cudamat as cm
-from cudamat import cudamat_conv_gemm as cc
+if os.environ.get('CUDAMAT_BACKEND', 'gpu') != 'cpu':
+  from cudamat import cudamat_conv_gemm as cc
 from cudamat import gpu_lock2 as gpu_lock
 import h5py
 
-import os
 import numpy as np
 import matplotlib.pyplot as plt
 plt.ion()
@@ -18,7 +20,16 @@ from google.protobuf import text_format
 from random import randint
 
 # Parameter is preety much a weight (consisting of weights and derivatives of weights)
+# The optimizer state is only allocated when the param is packed into a
+# ParamBuffer, which also does the updates.
 class Param(object):
+  # Optimizer state of each optimizer, saved as <name>_<state>.
+  STATE = {
+    config_pb2.Param.SGD: ['grad'],
+    config_pb2.Param.RMSPROP: ['grad_sqr'],
+    config_pb2.Param.ADAM: ['grad_mean', 'grad_sqr'],
+  }
+
   def __init__(self, w, config=None):
     if type(w) == np.ndarray:
       self.w_ = cm.CUDAMatrix(w)
@@ -27,10 +38,7 @@ class Param(object):
     else:
       self.w_ = w
     self.dw_ = cm.empty_like(self.w_)
-    self.dw_history_ = cm.empty_like(self.w_)
-    self.dw_history_sqrt_ = cm.empty_like(self.w_)
-    self.dw_sqr_ = cm.empty_like(self.w_)
-    self.dw_history_.assign(0)
+    self.state_ = None
     self.dw_.assign(0)
     self.t_ = 0
 
@@ -56,13 +64,17 @@ class Param(object):
     else:
       raise Exception('Unknown parameter initialization.')
 
+    self.optimizer_ = config.optimizer if config.HasField('optimizer') else None
     self.eps_ = config.epsilon
     self.momentum_ = config.momentum
     self.l2_decay_ = config.l2_decay
-    self.rmsprop_decay_ = 0.9
     self.gradient_clip_ = config.gradient_clip
     self.eps_decay_factor = config.eps_decay_factor
     self.eps_decay_after = config.eps_decay_after
+    self.rmsprop_decay_ = config.rmsprop_decay
+    self.adam_beta1_ = config.adam_beta1
+    self.adam_beta2_ = config.adam_beta2
+    self.damping_ = config.damping
 
   def __repr__(self):
     return self.w_.asarray().__repr__()
@@ -73,17 +85,19 @@ class Param(object):
   def Load(self, f, name):
     if name in f.keys():
       self.w_.overwrite(f[name].value)
-      self.dw_history_.overwrite(f['%s_grad' % name].value)
+      for state in self.STATE[self.optimizer_]:
+        state_name = '%s_%s' % (name, state)
+        if state_name in f.keys():
+          self.state_[state].overwrite(f[state_name].value)
+        else:
+          print "%s not found." % state_name
       self.t_ = f.attrs.get('%s_t' % name, 0)
     else:
       print "%s not found." % name
 
   def Save(self, f, name):
-    w_dset = f.create_dataset(name, self.w_.shape, dtype=np.float32)
-    w_dset[:, :] = self.w_.asarray()
-    w_dset = f.create_dataset('%s_grad' % name, self.dw_history_.shape, dtype=np.float32)
-    w_dset[:, :] = self.dw_history_.asarray()
-    f.attrs.__setitem__('%s_t' % name, self.t_)
+    WriteParam(f, name, self.w_.asarray(), dict((state, self.state_[state].asarray()) for state in self.STATE[self.optimizer_]),
+               self.t_)
 
   def GetW(self):
     return self.w_
@@ -91,36 +105,222 @@ class Param(object):
   def GetdW(self):
     return self.dw_
 
-  def Update(self):
-    if self.eps_decay_after > 0:
-      eps = self.eps_ * np.power(self.eps_decay_factor, self.t_ / self.eps_decay_after)
+  def GetSize(self):
+    return self.w_.shape[0] * self.w_.shape[1]
+
+  def SetDefaultOptimizer(self, optimizer):
+    if self.optimizer_ is None:
+      self.optimizer_ = optimizer
+
+  def GetOptimizer(self):
+    return self.optimizer_
+
+  # Params with the same update config are updated together.
+  def GetUpdateConfig(self):
+    if self.optimizer_ == config_pb2.Param.SGD:
+      hyperparams = (self.momentum_,)
+    elif self.optimizer_ == config_pb2.Param.RMSPROP:
+      hyperparams = (self.rmsprop_decay_, self.damping_)
     else:
-      eps = self.eps_
-
-    """
-    # RMSPROP
-    self.dw_history_.mult(self.rmsprop_decay_)
-    self.dw_.mult(self.dw_, target=self.dw_sqr_)
-    self.dw_history_.add_mult(self.dw_sqr_, mult=(1-self.rmsprop_decay_))
-    self.dw_history_.add(1e-07)
-    cm.sqrt(self.dw_history_, target=self.dw_history_sqrt_)
-
-    self.dw_.mult(-self.eps_)
-    self.dw_.divide(self.dw_history_sqrt_)
-
-    if self.gradient_clip_ > 0:
-      self.dw_.upper_bound_mod(self.gradient_clip_)
-    self.w_.add(self.dw_)
-    """
-
-    self.dw_history_.mult(self.momentum_)
-    self.dw_.add_mult(self.w_, mult=self.l2_decay_)
-    self.dw_history_.add_mult(self.dw_, -self.eps_)
-    if self.gradient_clip_ > 0:
-      self.dw_history_.upper_bound_mod(self.gradient_clip_)
-    self.w_.add(self.dw_history_)
-
-    self.t_ += 1
+      hyperparams = (self.adam_beta1_, self.adam_beta2_, self.damping_)
+    return (self.optimizer_, self.eps_, self.eps_decay_factor, self.eps_decay_after,
+            self.l2_decay_, self.gradient_clip_) + hyperparams
+
+  # The learning rate of the next update.
+  def GetEpsilon(self):
+    eps = self.eps_
+    if self.eps_decay_after > 0:
+      eps *= np.power(self.eps_decay_factor, self.t_ / self.eps_decay_after)
+    if self.optimizer_ == config_pb2.Param.ADAM:
+      t = self.t_ + 1
+      eps *= np.sqrt(1 - np.power(self.adam_beta2_, t)) / (1 - np.power(self.adam_beta1_, t))
+    return eps
+
+  # Moves w and dw into the given (1, size) views, state maps the optimizer
+  # state to its views. The state starts at zero.
+  def Pack(self, w, dw, state):
+    for view in [w, dw] + state.values():
+      view.reshape(self.w_.shape)
+    w.assign(self.w_)
+    dw.assign(self.dw_)
+    for view in state.values():
+      view.assign(0)
+    self.w_, self.dw_, self.state_ = w, dw, state
+
+# All params of a model in one flat buffer each for w and dw, each param
+# being a view into them. Params with the same update config are placed next
+# to each other, so Update is one fused update per distinct config instead of
+# a few ops per param. The optimizer state is allocated per optimizer, only
+# for the params that use it. Pack the params before Load, which writes into
+# the views.
+class ParamBuffer(object):
+  def __init__(self, params, optimizer=config_pb2.Param.SGD):
+    for p in params:
+      p.SetDefaultOptimizer(optimizer)
+    self.params_ = sorted(params, key=lambda p: p.GetUpdateConfig())
+    size = sum(p.GetSize() for p in self.params_)
+    self.w_ = cm.empty((1, size))
+    self.dw_ = cm.empty((1, size))
+
+    # params of the same optimizer are next to each other
+    ranges = {}
+    start = 0
+    for p in self.params_:
+      o = p.GetOptimizer()
+      end = start + p.GetSize()
+      ranges[o] = (ranges.get(o, (start, end))[0], end)
+      start = end
+    self.state_ = {}
+    for o, (start, end) in ranges.items():
+      self.state_[o] = dict((state, cm.empty((1, end - start))) for state in Param.STATE[o])
+
+    segments = []
+    start = 0
+    for p in self.params_:
+      end = start + p.GetSize()
+      offset = ranges[p.GetOptimizer()][0]
+      p.Pack(self.w_.col_slice(start, end), self.dw_.col_slice(start, end),
+             dict((state, buf.col_slice(start - offset, end - offset))
+                  for state, buf in self.state_[p.GetOptimizer()].items()))
+      config = p.GetUpdateConfig()
+      if len(segments) > 0 and segments[-1][2] == config:
+        segments[-1][1] = end
+      else:
+        segments.append([start, end, config, p])
+      start = end
+    # where the w and state of each param are in GetBuffers
+    self.buffers_ = [self.w_]
+    index = {}
+    for o in sorted(self.state_):
+      for state in sorted(self.state_[o]):
+        index[(o, state)] = len(self.buffers_)
+        self.buffers_.append(self.state_[o][state])
+    self.locations_ = {}
+    start = 0
+    for p in self.params_:
+      o = p.GetOptimizer()
+      offset = ranges[o][0]
+      self.locations_[p] = (start, dict((state, (index[(o, state)], start - offset)) for state in Param.STATE[o]))
+      start += p.GetSize()
+    self.segments_ = []
+    for start, end, config, p in segments:
+      offset = ranges[p.GetOptimizer()][0]
+      state = dict((state, buf.col_slice(start - offset, end - offset))
+                   for state, buf in self.state_[p.GetOptimizer()].items())
+      self.segments_.append((self.w_.col_slice(start, end), self.dw_.col_slice(start, end), state, p))
+
+  def GetSize(self):
+    return self.w_.shape[1]
+
+  def GetW(self):
+    return self.w_
+
+  def GetdW(self):
+    return self.dw_
+
+  # The flat buffers that are saved, w and the optimizer state.
+  def GetBuffers(self):
+    return self.buffers_
+
+  # Offset of param p in w and, for each of its states, the index of the
+  # buffer it is in and its offset in there.
+  def GetLocation(self, p):
+    return self.locations_[p]
+
+  # The hyperparams and the step count of a segment are those of its first
+  # param, the others only differ in their init.
+  def Update(self):
+    for w, dw, state, p in self.segments_:
+      eps = p.GetEpsilon()
+      optimizer = p.GetOptimizer()
+      if optimizer == config_pb2.Param.SGD:
+        cm.momentum_update(w, dw, state['grad'], eps, p.momentum_,
+                           l2_decay=p.l2_decay_, gradient_clip=p.gradient_clip_)
+      elif optimizer == config_pb2.Param.RMSPROP:
+        cm.rmsprop_update(w, dw, state['grad_sqr'], eps, p.rmsprop_decay_,
+                          l2_decay=p.l2_decay_, gradient_clip=p.gradient_clip_, damping=p.damping_)
+      elif optimizer == config_pb2.Param.ADAM:
+        cm.adam_update(w, dw, state['grad_mean'], state['grad_sqr'], eps, p.adam_beta1_, p.adam_beta2_,
+                       l2_decay=p.l2_decay_, gradient_clip=p.gradient_clip_, damping=p.damping_)
+      else:
+        raise Exception('Unknown optimizer.')
+    for p in self.params_:
+      p.t_ += 1
+
+def WriteParam(f, name, w, state, t):
+  w_dset = f.create_dataset(name, w.shape, dtype=np.float32)
+  w_dset[:, :] = w
+  for s, value in state.items():
+    w_dset = f.create_dataset('%s_%s' % (name, s), w.shape, dtype=np.float32)
+    w_dset[:, :] = value
+  f.attrs.__setitem__('%s_t' % name, t)
+
+class CheckpointWriter(object):
+  """Saves the params of a ParamBuffer in a background process.
+
+  Write only copies the buffers into shared memory and returns, after
+  waiting for the previous checkpoint to be written. The process writes them
+  as Param.Save would into <file>.tmp and renames it to the file, so that a
+  checkpoint is never left half written. params are the (name, param) pairs
+  of the model. Create it before other threads are started."""
+  def __init__(self, param_buffer, params):
+    self.buffers_ = param_buffer.GetBuffers()
+    sizes = [buf.shape[1] for buf in self.buffers_]
+    self.offsets_ = np.concatenate([[0], np.cumsum(sizes)[:-1]]).tolist()
+    self.shared_ = multiprocessing.RawArray('f', sum(sizes))
+    self.shared_np_ = np.frombuffer(self.shared_, dtype=np.float32)
+    self.params_ = params
+    self.layout_ = []
+    for name, p in params:
+      start, states = param_buffer.GetLocation(p)
+      self.layout_.append((name, p.GetW().shape, start,
+                           dict((state, self.offsets_[b] + offset) for state, (b, offset) in states.items())))
+    self.requests_ = multiprocessing.Queue()
+    self.done_ = multiprocessing.Queue()
+    self.pending_ = False
+    self.process_ = multiprocessing.Process(target=RunCheckpointWriter, args=(self.shared_, self.requests_, self.done_))
+    self.process_.daemon = True
+    self.process_.start()
+
+  def Write(self, filename):
+    self.Wait()
+    for buf, offset in zip(self.buffers_, self.offsets_):
+      buf.copy_to_host()
+      self.shared_np_[offset:offset + buf.shape[1]] = buf.numpy_array.ravel(order='F')
+    self.requests_.put((filename, self.layout_, [p.t_ for _, p in self.params_]))
+    self.pending_ = True
+
+  # Waits until the last checkpoint is written.
+  def Wait(self):
+    if self.pending_:
+      self.pending_ = False
+      error = self.done_.get()
+      if error is not None:
+        raise Exception('Writing checkpoint failed: %s' % error)
+
+  def Close(self):
+    self.Wait()
+    self.requests_.put(None)
+    self.process_.join()
+
+def RunCheckpointWriter(shared, requests, done):
+  data = np.frombuffer(shared, dtype=np.float32)
+  view = lambda offset, shape: data[offset:offset + shape[0] * shape[1]].reshape(shape, order='F')
+  while True:
+    request = requests.get()
+    if request is None:
+      break
+    filename, layout, ts = request
+    try:
+      f = h5py.File('%s.tmp' % filename, 'w')
+      for (name, shape, start, states), t in zip(layout, ts):
+        WriteParam(f, name, view(start, shape),
+                   dict((state, view(offset, shape)) for state, offset in states.items()), t)
+      f.close()
+      os.rename('%s.tmp' % filename, filename)
+      done.put(None)
+    except Exception as e:
+      done.put(str(e))
 
 def ReadDataProto(fname):
   data_pb = config_pb2.Data()
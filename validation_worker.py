@@ -0,0 +1,94 @@
+"""Validation in a separate process.
+
+The worker builds its own copy of the model and of the validation data
+handler. Validate copies w of the training model into shared memory and
+returns, the worker validates that snapshot while training goes on and
+GetResult hands back the outcome of model.Validate a few steps later. When
+the worker is still busy with the last snapshot, Validate skips this one, so
+training never waits for validation. Create the worker before setting up the
+GPU, the worker sets it up on its own.
+"""
+
+import multiprocessing
+from data_handler import *
+
+class ValidationWorker(object):
+  def __init__(self, model_class, model, valid_data_pb, board=0, seed=42):
+    size = model_class.GetNumParams(model)
+    self.shared_ = multiprocessing.RawArray('f', size)
+    self.shared_np_ = np.frombuffer(self.shared_, dtype=np.float32).reshape(1, size)
+    self.requests_ = multiprocessing.Queue()
+    self.results_ = multiprocessing.Queue()
+    self.busy_ = False
+    self.process_ = multiprocessing.Process(target=RunValidationWorker,
+                                            args=(model_class, model, valid_data_pb, board, seed, self.shared_,
+                                                  self.requests_, self.results_, os.getpid()))
+    self.process_.start()
+
+  # Starts validating w, the w of the ParamBuffer of the model after step.
+  # Returns False if the worker is still busy and nothing was started.
+  def Validate(self, w, step):
+    if self.busy_:
+      return False
+    w.copy_to_host()
+    self.shared_np_[:, :] = w.numpy_array
+    self.requests_.put(('validate', step))
+    self.busy_ = True
+    return True
+
+  # The step and the result of model.Validate of the last snapshot, None if
+  # there is none or, unless wait, it is not done yet.
+  def GetResult(self, wait=False):
+    while self.busy_:
+      try:
+        result = self.results_.get(timeout=1.0) if wait else self.results_.get_nowait()
+      except Queue.Empty:
+        if not self.process_.is_alive():
+          raise Exception('Validation worker failed.')
+        if wait:
+          continue
+        return None
+      if result is None:
+        raise Exception('Validation worker failed.')
+      self.busy_ = False
+      return result
+    return None
+
+  # Writes the params of the last validated snapshot to model_file, w only,
+  # the optimizer state starts from scratch when it is loaded.
+  def Save(self, model_file):
+    self.requests_.put(('save', model_file))
+
+  def Close(self):
+    self.requests_.put(None)
+    self.process_.join()
+
+def RunValidationWorker(model_class, model, valid_data_pb, board, seed, shared, requests, results, parent):
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    LockGPU(board=board)
+    cm.CUDAMatrix.init_random(seed)
+    np.random.seed(seed)
+    net = model_class(model)
+    valid_data = ChooseDataHandler(valid_data_pb)
+    net.SetUpValidation(valid_data)
+    w = np.frombuffer(shared, dtype=np.float32).reshape(1, -1)
+    while True:
+      try:
+        request = requests.get(timeout=1.0)
+      except Queue.Empty:
+        # stop if training died without closing the worker
+        if os.getppid() != parent:
+          break
+        continue
+      if request is None:
+        break
+      command, arg = request
+      if command == 'validate':
+        net.param_buffer_.GetW().overwrite(w)
+        results.put((arg, net.Validate(valid_data)))
+      else:
+        net.Save(arg)
+  except:
+    results.put(None)
+    raise